@@ -18,14 +18,16 @@
 # <http://www.gnu.org/licenses/>.
 
 import os
+import threading
 import traceback
 import logging
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 from collections import namedtuple
 from urlparse import urlparse, parse_qs
 
 from blackbox_connection import mysql_connection
-from section_9 import IndexEntry, date_of
+from section_9 import IndexEntry, DateCache
 
 Entry = namedtuple('Entry', 'date offset size')
 
@@ -37,9 +39,12 @@ class BlackBoxError(Exception):
 
 
 class BigIndex(object):
-    def __init__(self, path):
+    def __init__(self, path, date_cache):
         self._table = {}
         self._meid2date = {}
+        self._date_cache = date_cache
+        # Guards the tables, which are shared by all request threads.
+        self._lock = threading.Lock()
         self.path = path
         self.logger = logging.getLogger(type(self).__name__)
         self.logger.info("Will load DB files from %s", self.path)
@@ -48,11 +53,13 @@ class BigIndex(object):
         # Returns the source for the given source file at the revision
         # specified by its master_events ID.
         source_file_id, master_event_id = key
-        # Load the index if we've don't know about this meID.
-        if not self.has_seen_master_event_id(master_event_id):
-            self._add_to_table(self.date_of(master_event_id))
-        # By now, the table MUST have the entry, or else something went wrong.
-        entry = self._table[key]
+        with self._lock:
+            # Load the index if we've don't know about this meID.
+            if not self.has_seen_master_event_id(master_event_id):
+                self._add_to_table(self.date_of(master_event_id))
+            # By now, the table MUST have the entry, or else something went
+            # wrong.
+            entry = self._table[key]
         return self.get_source(entry)
 
     def get_source(self, entry):
@@ -77,7 +84,11 @@ class BigIndex(object):
         """
         if master_event_id not in self._meid2date:
             self.logger.info("Fetching date of %d", master_event_id)
-            self._meid2date[master_event_id] = date_of(master_event_id, cnx)
+            try:
+                date = self._date_cache[master_event_id]
+            except KeyError:
+                raise BlackBoxError('Unknown master event %d' % master_event_id)
+            self._meid2date[master_event_id] = date
         return self._meid2date[master_event_id]
 
     def _add_to_table(self, datestr):
@@ -90,17 +101,25 @@ class BigIndex(object):
         table = self._table
         meid2date = self._meid2date
 
+        learned = []
         filename = self.path_to('index-' + datestr)
         with open(filename, "rb") as index_file:
             for entry in IndexEntry.entries_from_file(index_file):
                 table[entry.key] = Entry(offset=entry.start,
                                          size=entry.length,
                                          date=datestr)
+                if entry.master_event_id not in meid2date:
+                    learned.append((entry.master_event_id, datestr))
                 meid2date[entry.master_event_id] = datestr
+        # Remember every date we've learned for the next time we start.
+        self._date_cache.update(learned)
         self.logger.debug("New index size: %d", len(table))
 
 
 class BlackBoxRequestHandler(BaseHTTPRequestHandler):
+    # Allow clients to keep their connections alive.
+    protocol_version = 'HTTP/1.1'
+
     def do_GET(self):
         "Get a source code file."
         url = urlparse(self.path)
@@ -134,12 +153,19 @@ class BlackBoxRequestHandler(BaseHTTPRequestHandler):
         self.wfile.write(contents)
 
 
-def run(path):
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    Handles each connection in its own thread.
+    """
+    daemon_threads = True
+
+
+def run(path, date_cache):
     "Run the HTTP server forever."
     global index
-    index = BigIndex(path)
+    index = BigIndex(path, date_cache)
     server_address = ('', 8080)
-    httpd = HTTPServer(server_address, BlackBoxRequestHandler)
+    httpd = ThreadedHTTPServer(server_address, BlackBoxRequestHandler)
     httpd.serve_forever()
 
 
@@ -155,4 +181,4 @@ if __name__ == '__main__':
         path = '/data/compile-inputs'
 
     with mysql_connection() as cnx:
-        run(path)
+        run(path, DateCache(cnx=cnx))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Copyright (C) 2017  Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Prints the date of many master_events ids at once.
+
+Reads one master_events id per line from stdin, and prints a TSV of the id and
+its ISO 8601 date. Dates are resolved in bulk and saved in the date cache, so
+that print-compile-input.py and compile-server.py never have to ask MySQL
+about them again.
+"""
+
+import argparse
+import sys
+
+from blackbox_connection import mysql_connection
+from section_9 import DateCache, DEFAULT_DATE_CACHE
+
+
+parser = argparse.ArgumentParser(
+    description='Prints the date of many master_events ids'
+)
+parser.add_argument('--date-cache', default=DEFAULT_DATE_CACHE,
+                    help='File that remembers the date of each master event')
+parser.add_argument('--batch-size', type=int, default=10000,
+                    help='How many ids to resolve at once')
+
+
+def master_event_ids():
+    for line in sys.stdin:
+        line = line.strip()
+        if line == '':
+            continue
+        yield int(line)
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with mysql_connection() as cnx:
+        date_cache = DateCache(args.date_cache, cnx)
+        for batch in batches(master_event_ids(), args.batch_size):
+            dates = date_cache.lookup_many(batch)
+            for meid in batch:
+                if meid in dates:
+                    print('%d\t%s' % (meid, dates[meid]))
+                else:
+                    sys.stderr.write('Unknown master event: %d\n' % (meid,))
@@ -18,12 +18,26 @@
 # <http://www.gnu.org/licenses/>.
 
 
+"""
+Lists the ids of all sessions with at least one compile event, in ascending
+order, without duplicates.
+
+With --state, the last session listed, and the time (and session) of the
+latest compile event seen, are recorded in a state file. The next run continues from
+there, so that nightly refreshes only list new sessions, and old sessions
+that have had compile events since.
+"""
+
 import argparse
 import datetime
+import json
+import os
+import sys
 from contextlib import closing
+from itertools import chain
 
-import sys
 from blackbox_connection import mysql_connection
+from rangeset import RangeSet
 
 
 def to_date(string):
@@ -33,19 +47,240 @@ def to_date(string):
 parser = argparse.ArgumentParser(description='List session IDs')
 parser.add_argument('until', type=to_date,
                     help="Date to stop collecting sessions in ISO 8601 format")
-parser.add_argument('minimum', type=int, default=0,
+parser.add_argument('minimum', type=int, nargs='?', default=0,
                     help="Minimum sequence number")
+parser.add_argument('--state', default=None,
+                    help="Resume from (and record progress in) this file")
+parser.add_argument('--page-size', type=int, default=10000,
+                    help="Number of sessions to fetch per query")
+parser.add_argument('--manifest', type=RangeSet.load, default=None,
+                    help="Only list sessions within these ranges")
 
-if __name__ == '__main__':
-    args = parser.parse_args()
-    with mysql_connection() as cnx:
+# Largest value of a signed BIGINT.
+MAX_ID = 2 ** 63 - 1
+
+
+class Watermark(object):
+    """
+    The last session that was completely listed, and the time of the latest
+    compile event of any listed session, along with that event's session.
+    Together, (created_at, latest_session_id) is a keyset: only compile
+    events strictly after it are new.
+    """
+
+    def __init__(self, session_id=0, created_at=None, latest_session_id=0):
+        self.session_id = session_id
+        self.created_at = created_at
+        self.latest_session_id = latest_session_id
+
+    @property
+    def latest(self):
+        return (self.created_at or '', self.latest_session_id)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads the watermark from the state file, if it exists.
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as state_file:
+            state = json.load(state_file)
+        return cls(state['session_id'], state['created_at'],
+                   state.get('latest_session_id', 0))
+
+    def save(self, path):
+        """
+        Atomically replaces the state file.
+        """
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as state_file:
+            json.dump({'session_id': self.session_id,
+                       'created_at': self.created_at,
+                       'latest_session_id': self.latest_session_id},
+                      state_file)
+        os.rename(temporary, path)
+
+
+def sessions_updated_since(cnx, until, watermark):
+    """
+    Yields (as one page) the (session_id, created_at) rows of sessions up
+    to the watermark's session that have a compile event after the
+    watermark's (created_at, latest_session_id) keyset (and before
+    `until`): sessions that were listed before, but have changed since.
+    """
+    with closing(cnx.cursor()) as cursor:
+        cursor.execute('''
+            SELECT session_id, MAX(created_at)
+              FROM master_events
+             WHERE event_type = 'CompileEvent'
+               AND (created_at > %s
+                    OR (created_at = %s AND session_id > %s))
+               AND created_at < DATE(%s)
+               AND session_id <= %s
+             GROUP BY session_id
+             ORDER BY session_id ASC
+        ''', (watermark.created_at, watermark.created_at,
+              watermark.latest_session_id, until, watermark.session_id))
+        page = cursor.fetchall()
+    if page:
+        yield page
+
+
+def sessions_after(cnx, until, minimum, page_size, maximum=MAX_ID):
+    """
+    Yields pages of (session_id, created_at) rows, where created_at is the
+    time of the session's last compile event before `until`. Only sessions
+    in (minimum, maximum] are listed.
+
+    Uses keyset pagination on session_id, so that each page is a cheap
+    index range scan, no matter how far into the table we are.
+    """
+    last = minimum
+    while True:
         with closing(cnx.cursor()) as cursor:
             cursor.execute('''
-                SELECT session_id
+                SELECT session_id, MAX(created_at)
                   FROM master_events
                  WHERE event_type = 'CompileEvent'
                    AND created_at < DATE(%s)
                    AND session_id > %s
-            ''', (args.until, args.minimum))
-            for session_id, in cursor:
-                print(session_id)
+                   AND session_id <= %s
+                 GROUP BY session_id
+                 ORDER BY session_id ASC
+                 LIMIT %s
+            ''', (until, last, maximum, page_size))
+            page = cursor.fetchall()
+        if not page:
+            break
+        yield page
+        last = page[-1][0]
+        if len(page) < page_size:
+            break
+
+
+def list_sessions(cnx, until, watermark, page_size, manifest=None,
+                  save=lambda watermark: None):
+    """
+    Yields the id of every session listed since the watermark, in ascending
+    order; calls save() with the new watermark after each page.
+    """
+    if manifest is None:
+        ranges = [(watermark.session_id + 1, MAX_ID)]
+    else:
+        remaining = manifest - RangeSet([(0, watermark.session_id)])
+        ranges = remaining.ranges
+
+    pages = chain(
+        sessions_updated_since(cnx, until, watermark)
+        if watermark.created_at is not None else (),
+        (page
+         for first, last in ranges
+         for page in sessions_after(cnx, until, first - 1, page_size, last))
+    )
+    for page in pages:
+        for session_id, _created_at in page:
+            if manifest is None or session_id in manifest:
+                yield session_id
+        # Only advance the watermark once the page has been written out.
+        created_at, latest_session_id = max(
+            [watermark.latest] +
+            [(str(created_at), session_id) for session_id, created_at in page]
+        )
+        watermark = Watermark(max(watermark.session_id, page[-1][0]),
+                              created_at, latest_session_id)
+        save(watermark)
+
+
+class _SQLiteConnection(object):
+    """
+    Just enough of a MySQL connection for test(), on SQLite.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        return _SQLiteCursor(self.conn.cursor())
+
+
+class _SQLiteCursor(object):
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, params):
+        self._cursor.execute(sql.replace('%s', '?'),
+                             [str(p) if isinstance(p, datetime.date) else p
+                              for p in params])
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+def test():
+    import sqlite3
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''
+        CREATE TABLE master_events (
+            session_id INT, event_type TEXT, created_at TEXT
+        )
+    ''')
+    add = 'INSERT INTO master_events VALUES (?, ?, ?)'
+    conn.executemany(add, [
+        (1, 'CompileEvent', '2017-01-01 10:00:00'),
+        (2, 'CompileEvent', '2017-01-01 11:00:00'),
+        (2, 'EditEvent', '2017-01-01 12:00:00'),
+        (3, 'CompileEvent', '2017-01-01 12:00:00'),
+    ])
+    cnx = _SQLiteConnection(conn)
+    saved = []
+    assert list(list_sessions(cnx, to_date('2017-01-02'), Watermark(), 2,
+                              save=saved.append)) == [1, 2, 3]
+    watermark = saved[-1]
+    assert (watermark.session_id, watermark.latest) == (
+        3, ('2017-01-01 12:00:00', 3))
+
+    # Only session 4 is new; session 3, whose last compile event is the
+    # watermark itself, must not be listed again.
+    conn.execute(add, (4, 'CompileEvent', '2017-01-02 10:00:00'))
+    saved = []
+    assert list(list_sessions(cnx, to_date('2017-01-03'), watermark, 2,
+                              save=saved.append)) == [4]
+    watermark = saved[-1]
+    assert (watermark.session_id, watermark.latest) == (
+        4, ('2017-01-02 10:00:00', 4))
+
+    # Session 1 is still active.
+    conn.execute(add, (1, 'CompileEvent', '2017-01-03 09:00:00'))
+    saved = []
+    assert list(list_sessions(cnx, to_date('2017-01-04'), watermark, 2,
+                              save=saved.append)) == [1]
+    assert (saved[-1].session_id, saved[-1].latest) == (
+        4, ('2017-01-03 09:00:00', 1))
+    print("Tests passed.")
+
+
+if __name__ == '__main__':
+    if '--test' in sys.argv:
+        test()
+        sys.exit()
+
+    args = parser.parse_args()
+    watermark = Watermark(args.minimum)
+    if args.state is not None:
+        previous = Watermark.load(args.state)
+        if previous.session_id > watermark.session_id:
+            watermark = previous
+
+    def save(watermark):
+        sys.stdout.flush()
+        if args.state is not None:
+            watermark.save(args.state)
+
+    with mysql_connection() as cnx:
+        for session_id in list_sessions(cnx, args.until, watermark,
+                                        args.page_size, args.manifest, save):
+            print(session_id)
@@ -23,13 +23,18 @@ fixed). The pairs must be verified by parsing them, and asserting the
 difference is a single lexeme.
 
 Each source snapshot can be obtained using print-compile-input.py.
+
+Session IDs are read from stdin, one per line, or from a range manifest (see
+rangeset.py).
 """
 
+import argparse
 import sys
 from contextlib import closing
 from collections import namedtuple
 
 from blackbox_connection import mysql_connection
+from rangeset import RangeSet
 
 
 Result = namedtuple('Result', 'master_event_id source_file_id success')
@@ -64,6 +69,11 @@ def yield_pairs(events):
             yield a.source_file_id, a.master_event_id, b.master_event_id
 
 
+parser = argparse.ArgumentParser(description='Print pairs of compile events')
+parser.add_argument('manifest', nargs='?', type=RangeSet.load, default=None,
+                    help='Range manifest of session IDs (default: stdin)')
+
+
 def sessions():
     for line in sys.stdin:
         line = line.strip()
@@ -73,8 +83,10 @@ def sessions():
 
 
 if __name__ == '__main__':
+    args = parser.parse_args()
+    session_ids = sessions() if args.manifest is None else args.manifest
     with mysql_connection() as cnx:
-        for session_id in sessions():
+        for session_id in session_ids:
             # Prints source file, and TWO master_events IDs.
             for source_file, before, after in find_pairs_in_session(session_id):
                 print('%d\t%d\t%d' % (source_file, before, after))
@@ -30,8 +30,7 @@ import sys
 
 from blackbox_connection import mysql_connection
 
-from section_9 import IndexEntry
-from section_9 import date_of as date_of_original
+from section_9 import IndexEntry, DateCache, DEFAULT_DATE_CACHE
 
 
 class Index(object):
@@ -65,7 +64,7 @@ def date_of(master_event_id):
     """
     Return the ISO 8601 date of the master_events id.
     """
-    return date_of_original(master_event_id, cnx)
+    return date_cache[master_event_id]
 
 
 def open_index(datestr):
@@ -77,12 +76,20 @@ def open_payload(datestr):
 
 
 def get_index(master_event_id):
-    return Index(date_of(master_event_id))
+    index = Index(date_of(master_event_id))
+    # Everything in this index happened on the same date; save what the
+    # cache doesn't already know for later.
+    meids = set(meid for _sfid, meid in index.table)
+    known = date_cache.lookup_many(meids, resolve=False)
+    date_cache.update((meid, index.datestr) for meid in meids
+                      if meid not in known)
+    return index
 
 
 def test():
-    global cnx
+    global date_cache
     with mysql_connection() as cnx:
+        date_cache = DateCache(cnx=cnx)
         index = get_index(35238)
         assert len(index) == 174752 / 32
         source_code = lookup(1246, 35238)
@@ -90,9 +97,10 @@ def test():
     print("Tests passed.")
 
 
-def main(source_file_id, master_event_id):
-    global cnx
+def main(source_file_id, master_event_id, date_cache_path):
+    global date_cache
     with mysql_connection() as cnx:
+        date_cache = DateCache(date_cache_path, cnx)
         source_code = lookup(source_file_id, master_event_id)
     # Reopen output in binary mode to prevent pipes from breaking from weird
     # implict encoding conversion.
@@ -115,6 +123,8 @@ parser.add_argument('source_file_id', type=int,
                     help='ID in the source_files table')
 parser.add_argument('master_event_id', type=int,
                     help='ID in the master_events table')
+parser.add_argument('--date-cache', default=DEFAULT_DATE_CACHE,
+                    help='File that remembers the date of each master event')
 
 
 if __name__ == '__main__':
@@ -125,4 +135,4 @@ if __name__ == '__main__':
     else:
         args = parser.parse_args()
         base_directory = args.directory
-        main(args.source_file_id, args.master_event_id)
+        main(args.source_file_id, args.master_event_id, args.date_cache)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Copyright (C) 2017  Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Range-encoded sets of integers (session ids, master_events ids, etc.)
+
+A manifest is a text file that lists one inclusive range per line: either
+"first last" or just "first" for a range of a single integer. Blank lines and
+lines starting with "#" are ignored. For example:
+
+    # Sessions 1 to 1000, and session 1337
+    1 1000
+    1337
+
+Manifests can be combined with set operations and split into shards with an
+equal number of integers each, so that large jobs can be spread across
+machines, and completed work can be subtracted when resuming. Run this file
+for the command line interface.
+
+Works with both Python 2 and Python 3.
+"""
+
+import argparse
+import sys
+from bisect import bisect_right
+
+
+class RangeSet(object):
+    """
+    An immutable set of integers, stored as sorted, disjoint, non-adjacent,
+    inclusive ranges.
+
+    >>> RangeSet([(5, 7), (1, 2), (3, 4), (10, 10)])
+    RangeSet([(1, 7), (10, 10)])
+    >>> len(RangeSet([(1, 7), (10, 10)]))
+    8
+    """
+
+    def __init__(self, ranges=()):
+        merged = []
+        for first, last in sorted(ranges):
+            if first > last:
+                raise ValueError('Empty range: %d %d' % (first, last))
+            if merged and first <= merged[-1][1] + 1:
+                if last > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], last)
+            else:
+                merged.append((first, last))
+        self.ranges = tuple(merged)
+        self._starts = [first for first, _ in merged]
+
+    @classmethod
+    def from_integers(cls, integers):
+        """
+        Squeezes integers (in any order) into as few ranges as possible.
+
+        >>> RangeSet.from_integers([4, 1, 2, 3, 9, 8, 2])
+        RangeSet([(1, 4), (8, 9)])
+        """
+        ranges = []
+        for num in sorted(set(integers)):
+            if ranges and num == ranges[-1][1] + 1:
+                ranges[-1][1] = num
+            else:
+                ranges.append([num, num])
+        return cls((first, last) for first, last in ranges)
+
+    @classmethod
+    def read(cls, manifest_file):
+        """
+        Reads a manifest from an open file.
+        """
+        ranges = []
+        for line_no, line in enumerate(manifest_file, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) == 1:
+                first = last = int(fields[0])
+            elif len(fields) == 2:
+                first, last = int(fields[0]), int(fields[1])
+            else:
+                raise ValueError('Invalid range on line %d: %r'
+                                 % (line_no, line))
+            ranges.append((first, last))
+        return cls(ranges)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a manifest from a file path; "-" is stdin.
+        """
+        if path == '-':
+            return cls.read(sys.stdin)
+        with open(path) as manifest_file:
+            return cls.read(manifest_file)
+
+    def write(self, manifest_file):
+        """
+        Writes the manifest to an open file.
+        """
+        for first, last in self.ranges:
+            if first == last:
+                manifest_file.write('%d\n' % (first,))
+            else:
+                manifest_file.write('%d %d\n' % (first, last))
+
+    def dump(self, path):
+        """
+        Writes the manifest to a file path; "-" is stdout.
+        """
+        if path == '-':
+            return self.write(sys.stdout)
+        with open(path, 'w') as manifest_file:
+            self.write(manifest_file)
+
+    def __iter__(self):
+        for first, last in self.ranges:
+            num = first
+            while num <= last:
+                yield num
+                num += 1
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.ranges)
+
+    def __bool__(self):
+        return bool(self.ranges)
+    __nonzero__ = __bool__
+
+    def __contains__(self, num):
+        """
+        >>> 5 in RangeSet([(1, 7)]), 8 in RangeSet([(1, 7)])
+        (True, False)
+        """
+        i = bisect_right(self._starts, num) - 1
+        return i >= 0 and num <= self.ranges[i][1]
+
+    def __eq__(self, other):
+        return isinstance(other, RangeSet) and self.ranges == other.ranges
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.ranges)
+
+    def __repr__(self):
+        return 'RangeSet(%r)' % (list(self.ranges),)
+
+    def union(self, other):
+        """
+        >>> RangeSet([(1, 3)]) | RangeSet([(4, 6), (9, 9)])
+        RangeSet([(1, 6), (9, 9)])
+        """
+        return RangeSet(self.ranges + other.ranges)
+    __or__ = union
+
+    def intersection(self, other):
+        """
+        >>> RangeSet([(1, 5), (8, 12)]) & RangeSet([(4, 9), (12, 20)])
+        RangeSet([(4, 5), (8, 9), (12, 12)])
+        """
+        result = []
+        mine, theirs = self.ranges, other.ranges
+        i = j = 0
+        while i < len(mine) and j < len(theirs):
+            first = max(mine[i][0], theirs[j][0])
+            last = min(mine[i][1], theirs[j][1])
+            if first <= last:
+                result.append((first, last))
+            # Advance whichever range ends first.
+            if mine[i][1] < theirs[j][1]:
+                i += 1
+            else:
+                j += 1
+        return RangeSet(result)
+    __and__ = intersection
+
+    def difference(self, other):
+        """
+        >>> RangeSet([(1, 10), (20, 30)]) - RangeSet([(3, 4), (9, 21)])
+        RangeSet([(1, 2), (5, 8), (22, 30)])
+        """
+        result = []
+        theirs = other.ranges
+        j = 0
+        for first, last in self.ranges:
+            # Skip everything that ends before this range starts.
+            while j < len(theirs) and theirs[j][1] < first:
+                j += 1
+            k = j
+            while k < len(theirs) and theirs[k][0] <= last:
+                if theirs[k][0] > first:
+                    result.append((first, theirs[k][0] - 1))
+                first = theirs[k][1] + 1
+                k += 1
+            if first <= last:
+                result.append((first, last))
+        return RangeSet(result)
+    __sub__ = difference
+
+    def split(self, n):
+        """
+        Splits into n shards with (nearly) the same number of integers each.
+
+        >>> RangeSet([(1, 5), (10, 14)]).split(3)
+        [RangeSet([(1, 4)]), RangeSet([(5, 5), (10, 11)]), RangeSet([(12, 14)])]
+        """
+        if n < 1:
+            raise ValueError('Must split into at least one shard')
+        total = len(self)
+        sizes = [total // n + (1 if i < total % n else 0) for i in range(n)]
+
+        shards = []
+        ranges = list(self.ranges)
+        for size in sizes:
+            shard = []
+            while size > 0:
+                first, last = ranges[0]
+                if last - first + 1 <= size:
+                    shard.append(ranges.pop(0))
+                    size -= last - first + 1
+                else:
+                    shard.append((first, first + size - 1))
+                    ranges[0] = (first + size, last)
+                    size = 0
+            shards.append(RangeSet(shard))
+        return shards
+
+
+parser = argparse.ArgumentParser(description='Manipulate range manifests')
+subparsers = parser.add_subparsers(dest='command')
+subparsers.add_parser('encode',
+                      help='Read integers from stdin and print a manifest')
+decode_parser = subparsers.add_parser('decode',
+                                      help='Print every integer in a manifest')
+decode_parser.add_argument('manifest')
+count_parser = subparsers.add_parser('count',
+                                     help='Print how many integers are in a manifest')
+count_parser.add_argument('manifest')
+for name in 'union', 'intersection', 'difference':
+    operation_parser = subparsers.add_parser(
+        name, help='Print the %s of two or more manifests' % (name,)
+    )
+    operation_parser.add_argument('manifests', nargs='+')
+split_parser = subparsers.add_parser(
+    'split', help='Write n shards as PREFIX-0, PREFIX-1, ...'
+)
+split_parser.add_argument('n', type=int)
+split_parser.add_argument('manifest')
+split_parser.add_argument('prefix')
+
+
+def integers(lines):
+    for line in lines:
+        line = line.strip()
+        if line == '':
+            continue
+        yield int(line)
+
+
+def main(args):
+    if args.command == 'encode':
+        RangeSet.from_integers(integers(sys.stdin)).write(sys.stdout)
+    elif args.command == 'decode':
+        for num in RangeSet.load(args.manifest):
+            print(num)
+    elif args.command == 'count':
+        print(len(RangeSet.load(args.manifest)))
+    elif args.command in ('union', 'intersection', 'difference'):
+        first, rest = args.manifests[0], args.manifests[1:]
+        result = RangeSet.load(first)
+        for path in rest:
+            result = getattr(result, args.command)(RangeSet.load(path))
+        result.write(sys.stdout)
+    elif args.command == 'split':
+        shards = RangeSet.load(args.manifest).split(args.n)
+        for i, shard in enumerate(shards):
+            shard.dump('%s-%d' % (args.prefix, i))
+    else:
+        parser.print_usage()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
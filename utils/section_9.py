@@ -22,7 +22,10 @@ Reads the index files with the format described in Section 9 of The BlueJ
 Blackbox Data Collection Researchers' Handbook, Section 9.1.
 """
 
+import os
+import sqlite3
 import struct
+import threading
 from collections import namedtuple
 from contextlib import closing
 from os import SEEK_END
@@ -96,3 +99,130 @@ def date_of(master_event_id, cnx):
         """, [master_event_id])
         row, = cur.fetchall()
         return str(row[0])
+
+
+def dates_of(master_event_ids, cnx, chunk_size=1000):
+    """
+    Bulk version of date_of(). Yields (master_event_id, date) pairs for all of
+    the given master_events ids that exist, in no particular order.
+
+    The ids are resolved chunk_size at a time. Chunks of densely packed ids
+    are fetched with a range query (which is index-friendly); sparse chunks
+    are fetched with WHERE id IN (...).
+    """
+    ids = sorted(set(master_event_ids))
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        first, last = chunk[0], chunk[-1]
+        with closing(cnx.cursor()) as cur:
+            if last - first < 2 * len(chunk):
+                wanted = set(chunk)
+                cur.execute("""
+                    SELECT id, DATE(created_at)
+                      FROM master_events
+                     WHERE id BETWEEN %s AND %s
+                """, [first, last])
+                for meid, date in cur:
+                    if meid in wanted:
+                        yield meid, str(date)
+            else:
+                cur.execute("""
+                    SELECT id, DATE(created_at)
+                      FROM master_events
+                     WHERE id IN (%s)
+                """ % ', '.join(['%s'] * len(chunk)), chunk)
+                for meid, date in cur:
+                    yield meid, str(date)
+
+
+# Shared by print-compile-input.py and compile-server.py.
+DEFAULT_DATE_CACHE = os.path.expanduser('~/.meid2date.sqlite3')
+
+
+class DateCache(object):
+    """
+    Persistent cache of master_events id -> ISO 8601 date.
+
+    The mapping is kept in a small SQLite file so that it survives restarts
+    and can be shared by several processes. Misses are resolved in bulk from
+    the MySQL database, if a connection is given. Safe to share between
+    threads.
+    """
+
+    def __init__(self, path=DEFAULT_DATE_CACHE, cnx=None):
+        self.path = path
+        self.cnx = cnx
+        self._memory = {}
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS meid2date (
+                    master_event_id INTEGER PRIMARY KEY,
+                    date            TEXT NOT NULL
+                )
+            """)
+
+    def __getitem__(self, master_event_id):
+        dates = self.lookup_many([master_event_id])
+        if master_event_id not in dates:
+            raise KeyError(master_event_id)
+        return dates[master_event_id]
+
+    def __contains__(self, master_event_id):
+        return master_event_id in self.lookup_many([master_event_id],
+                                                   resolve=False)
+
+    def lookup_many(self, master_event_ids, resolve=True):
+        """
+        Returns a dictionary of master_events id -> date for all of the
+        given ids that could be found. Ids missing from the cache are fetched
+        from MySQL in bulk (if resolve is True) and saved for next time.
+        """
+        with self._lock:
+            return self._lookup_many(master_event_ids, resolve)
+
+    def _lookup_many(self, master_event_ids, resolve):
+        found = {}
+        missing = []
+        for meid in set(master_event_ids):
+            if meid in self._memory:
+                found[meid] = self._memory[meid]
+            else:
+                missing.append(meid)
+
+        # Consult the file.
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            rows = self._db.execute("""
+                SELECT master_event_id, date
+                  FROM meid2date
+                 WHERE master_event_id IN (%s)
+            """ % ', '.join('?' * len(chunk)), chunk)
+            for meid, date in rows:
+                found[meid] = self._memory[meid] = str(date)
+
+        # Ask MySQL for whatever is left.
+        missing = [meid for meid in missing if meid not in found]
+        if missing and resolve and self.cnx is not None:
+            resolved = dict(dates_of(missing, self.cnx))
+            self.update(resolved)
+            found.update(resolved)
+        return found
+
+    def update(self, mapping):
+        """
+        Saves many master_events id -> date entries at once. Accepts either a
+        dictionary or an iterable of pairs.
+        """
+        pairs = mapping.items() if hasattr(mapping, 'items') else mapping
+        pairs = [(int(meid), str(date)) for meid, date in pairs]
+        with self._lock, self._db:
+            self._db.executemany("""
+                INSERT OR REPLACE INTO meid2date (master_event_id, date)
+                VALUES (?, ?)
+            """, pairs)
+            self._memory.update(pairs)
+
+    def close(self):
+        self._db.close()
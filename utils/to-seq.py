@@ -19,10 +19,16 @@
 
 """
 Squeeze multiple ascending integers into a few `seq` commands.
+
+See rangeset.py for a manifest format that can be read back by the other
+scripts.
 """
 
 import sys
 
+from rangeset import RangeSet
+
+
 def print_command(first, last):
     if first == last:
         print("echo %d" %(first,))
@@ -30,22 +36,14 @@ def print_command(first, last):
         print("seq %d %d" %(first, last))
 
 
-first = None
+def integers():
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            break
+        yield int(line)
+
+
 print("#!/bin/sh")
-for line in sys.stdin:
-    line = line.strip()
-    if not line:
-        break
-    num = int(line)
-
-    if first is None:
-        first = last = num
-        continue
-
-    if num == last + 1:
-        last = num
-    else:
-        # This marks a new range. Output the last one.
-        print_command(first, last)
-        # And start the new range.
-        first = last = num
+for first, last in RangeSet.from_integers(integers()).ranges:
+    print_command(first, last)
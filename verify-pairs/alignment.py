@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright 2017 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Edit distance between token sequences, when only small distances matter.
+
+Only pairs at a distance of 1 (or at most a handful) are ever used, so
+there's no need to fill in the whole O(n·m) Levenshtein table of two
+files: after skipping the common prefix and suffix, only a diagonal band
+of width 2k + 1 can hold a distance of at most k.
+"""
+
+import argparse
+import random
+import timeit
+from typing import List, Optional, Sequence, Tuple
+
+from Levenshtein import distance, editops  # type: ignore
+
+# In the same format as Levenshtein.editops():
+# ('replace' | 'insert' | 'delete', source position, destination position)
+EditOp = Tuple[str, int, int]
+
+
+def _has_score_cutoff() -> bool:
+    """
+    Newer versions of the Levenshtein module can stop at a maximum distance.
+    """
+    try:
+        distance('', '', score_cutoff=0)
+    except TypeError:
+        return False
+    return True
+
+
+HAS_SCORE_CUTOFF = _has_score_cutoff()
+
+
+def common_affixes(a: Sequence, b: Sequence) -> Tuple[int, int]:
+    """
+    Returns the lengths of the longest common prefix and the longest common
+    suffix (that doesn't overlap the prefix) of a and b.
+
+    >>> common_affixes('class A {', 'class A { }')
+    (9, 0)
+    >>> common_affixes('int x = 1;', 'int y = 1;')
+    (4, 5)
+    >>> common_affixes('aaa', 'aa')
+    (2, 0)
+    """
+    shortest = min(len(a), len(b))
+    # Binary search, so that comparisons are made by slices (in C!) rather
+    # than one element at a time.
+    low, high = 0, shortest
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    prefix = low
+
+    low, high = 0, shortest - prefix
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            low = mid
+        else:
+            high = mid - 1
+    return prefix, low
+
+
+def bounded_distance(a: Sequence, b: Sequence, k: int, *,
+                     score_cutoff: bool=HAS_SCORE_CUTOFF) -> Optional[int]:
+    """
+    Returns the Levenshtein distance between a and b if it is at most k,
+    or None otherwise. Cheap checks on the common prefix, suffix, and
+    lengths settle most pairs without computing any distance at all; what's
+    left goes to banded_distance(), or for strings, to the Levenshtein
+    module with a score_cutoff, if it has one.
+
+    >>> bounded_distance('class A {', 'class A {}', 1)
+    1
+    >>> bounded_distance('kitten', 'sitting', 3)
+    3
+    >>> bounded_distance('kitten', 'sitting', 2) is None
+    True
+    """
+    prefix, suffix = common_affixes(a, b)
+    a = a[prefix:len(a) - suffix]
+    b = b[prefix:len(b) - suffix]
+    if len(a) > len(b):
+        a, b = b, a
+    m, n = len(a), len(b)
+    if n - m > k:
+        return None
+    if m == 0:
+        return n
+    if k == 1:
+        # The sequences now differ at both ends, which a single edit can
+        # only explain if they're at most one item long.
+        return n if n == 1 else None
+
+    if score_cutoff and isinstance(a, str) and isinstance(b, str):
+        # Bounded in C; over k comes back as k + 1.
+        result = distance(a, b, score_cutoff=k)
+        return result if result <= k else None
+    return banded_distance(a, b, k)
+
+
+def banded_distance(a: Sequence, b: Sequence, k: int) -> Optional[int]:
+    """
+    Returns the Levenshtein distance between a and b if it is at most k,
+    or None otherwise, by filling in only the cells within k of the
+    diagonal, and giving up as soon as a whole row is over k.
+    Expects len(a) <= len(b).
+
+    >>> banded_distance(list('kitten'), list('sitting'), 3)
+    3
+    """
+    m, n = len(a), len(b)
+    # Anything over the bound is as good as infinite.
+    over = k + 1
+    previous = [j if j <= k else over for j in range(n + 1)]
+    current = [over] * (n + 1)
+    for i in range(1, m + 1):
+        low = max(1, i - k)
+        high = min(n, i + k)
+        current[low - 1] = i if low == 1 else over
+        if high < n:
+            current[high + 1] = over
+        row_minimum = current[low - 1]
+        item = a[i - 1]
+        for j in range(low, high + 1):
+            cost = previous[j - 1] + (item != b[j - 1])
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if current[j - 1] + 1 < cost:
+                cost = current[j - 1] + 1
+            current[j] = cost
+            if cost < row_minimum:
+                row_minimum = cost
+        if row_minimum > k:
+            return None
+        previous, current = current, previous
+
+    result = previous[n]
+    return result if result <= k else None
+
+
+def bounded_editops(a: Sequence, b: Sequence,
+                    k: int) -> Optional[List[EditOp]]:
+    """
+    Returns the edit operations that turn a into b, if there are at most k
+    of them, or None otherwise. Only the middle that's left after skipping
+    the common prefix and suffix is aligned, with banded_editops().
+
+    >>> bounded_editops('int x = 1', 'int x = 1;', 2)
+    [('insert', 9, 9)]
+    >>> bounded_editops('int x = 1', 'int y = 2;', 2) is None
+    True
+    """
+    prefix, suffix = common_affixes(a, b)
+    ops = banded_editops(a[prefix:len(a) - suffix],
+                         b[prefix:len(b) - suffix], k)
+    if ops is None:
+        return None
+    return [(name, i + prefix, j + prefix) for name, i, j in ops]
+
+
+def banded_editops(a: Sequence, b: Sequence,
+                   k: int) -> Optional[List[EditOp]]:
+    """
+    Aligns a and b within a band of k on either side of the diagonal, and
+    traces back the edit operations, if there are at most k of them.
+    Takes O(k·n) time and space.
+
+    >>> banded_editops('kitten', 'sitting', 3)
+    [('replace', 0, 0), ('replace', 4, 4), ('insert', 6, 6)]
+    """
+    m, n = len(a), len(b)
+    if abs(n - m) > k:
+        return None
+
+    # rows[i][k + j - i] is the distance between a[:i] and b[:j].
+    over = k + 1
+    width = 2 * k + 1
+    first = [over] * width
+    for j in range(min(n, k) + 1):
+        first[k + j] = j
+    rows = [first]
+    previous = first
+    for i in range(1, m + 1):
+        current = [over] * width
+        item = a[i - 1]
+        for d in range(max(0, k - i), min(width, k + n - i + 1)):
+            j = i + d - k
+            if j == 0:
+                current[d] = i
+                continue
+            cost = previous[d] + (item != b[j - 1])
+            if d + 1 < width and previous[d + 1] + 1 < cost:
+                cost = previous[d + 1] + 1
+            if d > 0 and current[d - 1] + 1 < cost:
+                cost = current[d - 1] + 1
+            current[d] = cost if cost < over else over
+        if min(current) > k:
+            return None
+        rows.append(current)
+        previous = current
+
+    if rows[m][k + n - m] > k:
+        return None
+
+    ops = []  # type: List[EditOp]
+    i, j = m, n
+    while i > 0 or j > 0:
+        d = k + j - i
+        here = rows[i][d]
+        if i > 0 and j > 0 and rows[i - 1][d] + (a[i - 1] != b[j - 1]) == here:
+            if a[i - 1] != b[j - 1]:
+                ops.append(('replace', i - 1, j - 1))
+            i, j = i - 1, j - 1
+        elif i > 0 and d + 1 < width and rows[i - 1][d + 1] + 1 == here:
+            ops.append(('delete', i - 1, j))
+            i -= 1
+        else:
+            ops.append(('insert', i, j - 1))
+            j -= 1
+    ops.reverse()
+    return ops
+
+
+def apply_editops(ops: Sequence[EditOp], a: str, b: str) -> str:
+    """
+    Applies edit operations to a, taking new items from b.
+    """
+    result = list(a)
+    # Go backwards, so that source positions stay put.
+    for name, i, j in reversed(ops):
+        if name == 'replace':
+            result[i] = b[j]
+        elif name == 'delete':
+            del result[i]
+        else:
+            result.insert(i, b[j])
+    return ''.join(result)
+
+
+def test_bounded_editops() -> None:
+    rng = random.Random(4321)
+    for _ in range(500):
+        a = ''.join(rng.choice('abc') for _ in range(rng.randrange(12)))
+        b = ''.join(rng.choice('abc') for _ in range(rng.randrange(12)))
+        exact = distance(a, b)
+        for k in range(5):
+            ops = bounded_editops(a, b, k)
+            if exact > k:
+                assert ops is None
+            else:
+                assert ops is not None and len(ops) == exact, (a, b, k)
+                assert apply_editops(ops, a, b) == b
+                assert apply_editops(editops(a, b), a, b) == b
+
+
+def test_bounded_distance() -> None:
+    rng = random.Random(1234)
+    for _ in range(500):
+        a = ''.join(rng.choice('abc') for _ in range(rng.randrange(12)))
+        b = ''.join(rng.choice('abc') for _ in range(rng.randrange(12)))
+        exact = distance(a, b)
+        for k in range(5):
+            expected = exact if exact <= k else None
+            assert bounded_distance(a, b, k) == expected, (a, b, k)
+            assert bounded_distance(a, b, k, score_cutoff=False) == expected
+            assert bounded_distance(list(a), list(b), k) == expected
+            short, long = sorted((a, b), key=len)
+            assert banded_distance(short, long, k) == expected
+
+
+def benchmark(length: int, edits: int, k: int, number: int) -> None:
+    """
+    Compares the full Levenshtein distance with bounded_distance() on
+    random token sequences with a few random edits, encoded as strings as
+    in distance.py.
+    """
+    rng = random.Random(0)
+    alphabet = [chr(0x100000 + i) for i in range(100)]
+    pairs = []
+    for _ in range(number):
+        a = [rng.choice(alphabet) for _ in range(length)]
+        b = list(a)
+        for _ in range(edits):
+            position = rng.randrange(len(b))
+            if rng.random() < 0.5:
+                b[position] = rng.choice(alphabet)
+            else:
+                del b[position]
+        pairs.append((''.join(a), ''.join(b)))
+
+    def per_pair(func) -> float:
+        seconds = timeit.timeit(lambda: [func(a, b) for a, b in pairs],
+                                number=1)
+        return 1000 * seconds / number
+
+    print(f"{number} pairs of {length} tokens, {edits} edits, k={k}")
+    print(f"  Levenshtein.distance:            "
+          f"{per_pair(distance):8.3f} ms/pair")
+    for score_cutoff in sorted({False, HAS_SCORE_CUTOFF}):
+        method = 'score_cutoff' if score_cutoff else 'banded'
+        milliseconds = per_pair(lambda a, b: bounded_distance(
+            a, b, k, score_cutoff=score_cutoff
+        ))
+        print(f"  bounded_distance ({method + '):':14}"
+              f"{milliseconds:8.3f} ms/pair")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark bounded_distance() against Levenshtein')
+    parser.add_argument('--length', type=int, default=2000)
+    parser.add_argument('--edits', type=int, default=1)
+    parser.add_argument('-k', type=int, default=1)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+    benchmark(args.length, args.edits, args.k, args.number)
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright 2017 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Transparent compression of the before and after sources in the mistake table.
+
+Sources are compressed with zstd, using a dictionary trained on a sample of
+the corpus: Java files are small and repetitive, so a dictionary of common
+boilerplate does much better than compressing each file on its own.
+
+Stored values are tagged with a format version, so old and new rows can be
+mixed freely:
+
+    raw source (if it doesn't start with a NUL byte)
+    b'\\x00' b'\\x00' <raw source>
+    b'\\x00' b'\\x01' <dictionary id: uint32 LE> <zstd frame>
+    b'\\x00' b'\\x02' <prefix: uint32 LE> <suffix: uint32 LE> <middle>
+
+The last is a delta against another source (the base; for an after, its
+before): the first prefix bytes of the base, then middle, then the last
+suffix bytes of the base.
+
+Run this module to train a dictionary and recompress a database in place.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import struct
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None  # type: ignore
+
+# Use tqdm only if it's installed.
+try:
+    from tqdm import tqdm  # type: ignore
+except ImportError:
+    def tqdm(it, *_args, **_kwargs):
+        yield from it
+
+from alignment import common_affixes
+from database import DATABASE, connect
+
+RAW = 0
+ZSTD_WITH_DICTIONARY = 1
+DELTA = 2
+
+TAG = b'\x00'
+header_fmt = struct.Struct('<cBI')
+delta_fmt = struct.Struct('<cBII')
+
+SCHEMA = r"""
+CREATE TABLE IF NOT EXISTS zstd_dictionary(
+    id          INTEGER PRIMARY KEY,
+    dictionary  BLOB NOT NULL
+);
+"""
+
+
+def format_of(blob: bytes) -> int:
+    """
+    >>> format_of(b'class A {}')
+    0
+    >>> format_of(b'\\x00\\x01\\x01\\x00\\x00\\x00...')
+    1
+    """
+    if not blob.startswith(TAG):
+        return RAW
+    return blob[1]
+
+
+def raw(source: bytes) -> bytes:
+    """
+    Stores the source as is; unless it starts with a NUL byte, which would
+    make it look like one of the other formats.
+
+    >>> raw(b'class A {}')
+    b'class A {}'
+    >>> raw(b'\\x00\\x02')
+    b'\\x00\\x00\\x00\\x02'
+    """
+    if source.startswith(TAG):
+        return TAG + bytes([RAW]) + source
+    return source
+
+
+class Codec:
+    """
+    Compresses and decompresses sources with the dictionaries stored in a
+    database. New sources are compressed with the latest dictionary, if
+    there is one (and zstandard is installed), and if that makes them
+    smaller; otherwise they're left as is.
+    Not safe to share between threads.
+    """
+    def __init__(self, conn: sqlite3.Connection, *, level: int=19) -> None:
+        self.conn = conn
+        self.level = level
+        self._decompressors = {}  # type: Dict[int, zstandard.ZstdDecompressor]
+        self._compressor = None  # type: Optional[zstandard.ZstdCompressor]
+        self.dictionary_id = None  # type: Optional[int]
+        latest = self._dictionary()
+        if latest is not None and zstandard is not None:
+            self.dictionary_id = latest[0]
+
+    def _dictionary(self, dictionary_id: Optional[int]=None
+                    ) -> Optional[Tuple[int, bytes]]:
+        query = 'SELECT id, dictionary FROM zstd_dictionary'
+        if dictionary_id is None:
+            query += ' ORDER BY id DESC LIMIT 1'
+            params = ()  # type: Tuple
+        else:
+            query += ' WHERE id = ?'
+            params = (dictionary_id,)
+        try:
+            return self.conn.execute(query, params).fetchone()
+        except sqlite3.OperationalError:
+            # No such table: nothing has ever been compressed.
+            return None
+
+    @property
+    def compresses(self) -> bool:
+        return self.dictionary_id is not None
+
+    def encode(self, source: bytes) -> bytes:
+        if self.dictionary_id is None:
+            return raw(source)
+        if self._compressor is None:
+            # Only prepared on first use: readers never need it.
+            row = self._dictionary(self.dictionary_id)
+            assert row is not None, 'the dictionary was found before'
+            _id, data = row
+            # The header already says which dictionary to use.
+            self._compressor = zstandard.ZstdCompressor(
+                level=self.level,
+                dict_data=zstandard.ZstdCompressionDict(data),
+                write_dict_id=False
+            )
+        compressed = (
+            header_fmt.pack(TAG, ZSTD_WITH_DICTIONARY, self.dictionary_id) +
+            self._compressor.compress(source)
+        )
+        # Tiny files may not be worth it.
+        return compressed if len(compressed) < len(source) else raw(source)
+
+    def encode_delta(self, source: bytes, base: bytes) -> bytes:
+        """
+        Encodes source as a delta against base, if that's smaller.
+        """
+        prefix, suffix = common_affixes(base, source)
+        delta = (delta_fmt.pack(TAG, DELTA, prefix, suffix) +
+                 source[prefix:len(source) - suffix])
+        return delta if len(delta) < len(source) else self.encode(source)
+
+    def decode(self, blob: bytes, base: Optional[bytes]=None) -> bytes:
+        """
+        Returns the original source. Deltas need their (decoded) base.
+        """
+        version = format_of(blob)
+        if version == RAW:
+            # Sources that start with a NUL byte have a header.
+            return blob[2:] if blob.startswith(TAG) else blob
+        if version == DELTA:
+            if base is None:
+                raise ValueError('A delta needs its base to be decoded')
+            _tag, _version, prefix, suffix = delta_fmt.unpack_from(blob)
+            return (base[:prefix] + blob[delta_fmt.size:] +
+                    base[len(base) - suffix:])
+        if version != ZSTD_WITH_DICTIONARY:
+            raise ValueError(f'Unknown source format: {version}')
+        if zstandard is None:
+            raise RuntimeError('Source is compressed; install zstandard')
+        _tag, _version, dictionary_id = header_fmt.unpack_from(blob)
+        return self._decompressor(dictionary_id).decompress(
+            blob[header_fmt.size:]
+        )
+
+    def _decompressor(self, dictionary_id: int):
+        if dictionary_id not in self._decompressors:
+            row = self._dictionary(dictionary_id)
+            if row is None:
+                raise ValueError(f'No zstd dictionary {dictionary_id}')
+            self._decompressors[dictionary_id] = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(row[1])
+            )
+        return self._decompressors[dictionary_id]
+
+
+def train(conn: sqlite3.Connection, *, samples: int=10000,
+          dict_size: int=112640, seed: int=0) -> int:
+    """
+    Trains a dictionary on a random sample of sources, stores it, and
+    returns its ID.
+    """
+    codec = Codec(conn)
+    rowids = [rowid for rowid, in conn.execute('SELECT rowid FROM mistake')]
+    chosen = random.Random(seed).sample(rowids, min(samples, len(rowids)))
+    corpus = []  # type: List[Any]
+    for rowid in chosen:
+        before, after = conn.execute(
+            'SELECT before, after FROM mistake WHERE rowid = ?', (rowid,)
+        ).fetchone()
+        before = codec.decode(before)
+        corpus += [before, codec.decode(after, before)]
+    dictionary = zstandard.train_dictionary(dict_size, corpus)
+    with conn:
+        conn.executescript(SCHEMA)
+        cursor = conn.execute(
+            'INSERT INTO zstd_dictionary(dictionary) VALUES (?)',
+            (dictionary.as_bytes(),)
+        )
+    assert cursor.lastrowid is not None
+    return cursor.lastrowid
+
+
+def recompress(conn: sqlite3.Connection, codec: Codec, *,
+               batch_size: int=1000) -> None:
+    """
+    Rewrites every source in the mistake table with the codec, in place,
+    one transaction per batch of rows.
+    """
+    total, = conn.execute('SELECT COUNT(*) FROM mistake').fetchone()
+    progress = iter(tqdm(range(total), unit='mistake'))
+    last_rowid = -1
+    while True:
+        # Read a whole batch before writing, rather than updating the table
+        # under a running SELECT.
+        rows = conn.execute('''
+            SELECT rowid, before, after FROM mistake
+             WHERE rowid > ? ORDER BY rowid LIMIT ?
+        ''', (last_rowid, batch_size)).fetchall()
+        if not rows:
+            break
+        with conn:
+            conn.executemany('''
+                UPDATE mistake SET before = ?, after = ? WHERE rowid = ?
+            ''', [recoded(codec, before, after) + (rowid,)
+                  for rowid, before, after in rows])
+        last_rowid = rows[-1][0]
+        for _ in rows:
+            next(progress, None)
+
+
+def recoded(codec: Codec, before: bytes, after: bytes) -> Tuple[bytes, bytes]:
+    """
+    Encodes a pair of stored sources again; deltas stay deltas.
+    """
+    source = codec.decode(before)
+    if format_of(after) == DELTA:
+        return (codec.encode(source),
+                codec.encode_delta(codec.decode(after, source), source))
+    return codec.encode(source), codec.encode(codec.decode(after))
+
+
+def stored_size(conn: sqlite3.Connection) -> int:
+    size, = conn.execute('''
+        SELECT SUM(LENGTH(before) + LENGTH(after)) FROM mistake
+    ''').fetchone()
+    return size or 0
+
+
+def file_size(conn: sqlite3.Connection) -> int:
+    pages, = conn.execute('PRAGMA page_count').fetchone()
+    page_size, = conn.execute('PRAGMA page_size').fetchone()
+    return pages * page_size
+
+
+def read_speed(conn: sqlite3.Connection, rowids: Iterable[int]) -> float:
+    """
+    Returns how many mistakes per second can be read and decoded.
+    """
+    codec = Codec(conn)
+    rowids = list(rowids)
+    start = time.perf_counter()
+    for rowid in rowids:
+        before, after = conn.execute(
+            'SELECT before, after FROM mistake WHERE rowid = ?', (rowid,)
+        ).fetchone()
+        codec.decode(after, codec.decode(before))
+    return len(rowids) / max(time.perf_counter() - start, 1e-9)
+
+
+def test_delta() -> None:
+    codec = Codec(sqlite3.connect(':memory:'))
+    before = b'class A {\n    int x = 1\n}\n' * 10
+    after = b'class A {\n    int x = 1;\n}\n' + before[24:]
+    delta = codec.encode_delta(after, before)
+    assert format_of(delta) == DELTA
+    assert len(delta) < 20
+    assert codec.decode(delta, before) == after
+    # Identical sources, and tiny sources.
+    assert codec.decode(codec.encode_delta(before, before), before) == before
+    assert codec.encode_delta(b'a', b'b') == b'a'
+
+
+def test_raw_nul() -> None:
+    codec = Codec(sqlite3.connect(':memory:'))
+    # Would otherwise look like a delta, or an unknown format.
+    for source in [b'\x00\x02' + 8 * b'\x00' + b'class A {',
+                   b'\x00\x07', b'\x00', b'\x00\x00']:
+        assert format_of(codec.encode(source)) == RAW
+        assert codec.decode(codec.encode(source)) == source
+        assert codec.decode(codec.encode_delta(source, b'x')) == source
+
+
+def test_codec() -> None:
+    import pytest  # type: ignore
+    pytest.importorskip('zstandard')
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE mistake(before BLOB, after BLOB)')
+    sources = [(f'public class A{i} {{\n'
+                f'    public static void main(String[] args) {{\n'
+                f'        System.out.println("Hello, {i}!");\n'
+                f'    }}\n'
+                f'}}\n').encode() for i in range(500)]
+    conn.executemany('INSERT INTO mistake VALUES (?, ?)',
+                     zip(sources, sources))
+    assert not Codec(conn).compresses
+
+    train(conn, samples=200, dict_size=4096)
+    codec = Codec(conn)
+    recompress(conn, codec)
+    stored = [b for b, in conn.execute('SELECT before FROM mistake')]
+    assert all(format_of(b) == ZSTD_WITH_DICTIONARY for b in stored)
+    assert [codec.decode(b) for b in stored] == sources
+    assert stored_size(conn) < sum(2 * len(s) for s in sources)
+    # Deltas survive recompression.
+    delta = codec.encode_delta(sources[1], sources[0])
+    assert format_of(delta) == DELTA
+    conn.execute('UPDATE mistake SET after = ? WHERE rowid = 1', (delta,))
+    recompress(conn, codec)
+    after, = conn.execute('SELECT after FROM mistake WHERE rowid = 1').fetchone()
+    assert after == delta
+
+    # Raw sources still read fine; and stay raw if they're tiny.
+    assert codec.decode(b'class B {}') == b'class B {}'
+    assert codec.encode(b'class B {}') == b'class B {}'
+
+
+parser = argparse.ArgumentParser(
+    description='Train a zstd dictionary and recompress mistake sources')
+parser.add_argument('--database', default=DATABASE)
+parser.add_argument('--samples', type=int, default=10000,
+                    help='mistakes to train the dictionary on '
+                         '(default: %(default)s)')
+parser.add_argument('--dict-size', type=int, default=112640,
+                    help='dictionary size in bytes (default: %(default)s)')
+parser.add_argument('--level', type=int, default=19,
+                    help='zstd compression level (default: %(default)s)')
+parser.add_argument('--vacuum', action='store_true',
+                    help='VACUUM afterwards, to return free pages to the '
+                         'file system')
+
+
+def main(args) -> None:
+    if zstandard is None:
+        raise SystemExit('Please install zstandard')
+    conn = connect(args.database)
+    sample = [rowid for rowid, in conn.execute(
+        'SELECT rowid FROM mistake ORDER BY random() LIMIT 1000'
+    )]
+    before = stored_size(conn), file_size(conn), read_speed(conn, sample)
+
+    dictionary_id = train(conn, samples=args.samples, dict_size=args.dict_size)
+    print(f"Trained dictionary {dictionary_id}")
+    recompress(conn, Codec(conn, level=args.level))
+    if args.vacuum:
+        conn.execute('VACUUM')
+    after = stored_size(conn), file_size(conn), read_speed(conn, sample)
+
+    for name, old, new in zip(('Sources (bytes)', 'File (bytes)',
+                               'Reads (mistakes/s)'), before, after):
+        print(f"{name:20} {old:16,.0f} -> {new:16,.0f} "
+              f"({new / max(old, 1):.2f}x)")
+    if not args.vacuum:
+        print("Run again with --vacuum (or VACUUM) to shrink the file.")
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright 2017 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shared access to java-mistakes.sqlite3.
+
+Every connection uses write-ahead logging, so readers never block the
+writer (or each other), and transactions are durable. Writes should go
+through a single WriteQueue, which commits them in batches, so that any
+number of threads (or forked processes) can produce rows without fighting
+over SQLite's one write lock.
+"""
+
+import multiprocessing
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Iterable, List, Optional, Sequence, Tuple, Union
+
+DATABASE = 'java-mistakes.sqlite3'
+
+# A transaction, as sent to the writer: each statement with its rows.
+Statements = List[Tuple[str, List[Sequence[Any]]]]
+
+
+def connect(path: str=DATABASE, *, timeout: float=60.0,
+            cache_size_mib: int=64, mmap_size_mib: int=1024,
+            synchronous: str='FULL', **kwargs) -> sqlite3.Connection:
+    """
+    Opens the database in WAL mode, with a larger page cache, memory-mapped
+    reads, and waiting up to timeout seconds for locks rather than failing.
+    Extra keyword arguments are passed on to sqlite3.connect().
+    """
+    conn = sqlite3.connect(path, timeout=timeout, **kwargs)
+    conn.execute('PRAGMA journal_mode = WAL')
+    # With WAL, FULL only syncs the log on commit; with batched commits,
+    # that's cheap enough to never lose a committed transaction.
+    conn.execute(f'PRAGMA synchronous = {synchronous}')
+    conn.execute(f'PRAGMA cache_size = {-1024 * cache_size_mib}')
+    conn.execute(f'PRAGMA mmap_size = {1024 * 1024 * mmap_size_mib}')
+    return conn
+
+
+class Transaction:
+    """
+    Collects statements to send to a WriteQueue as one transaction.
+    Quacks enough like a connection for `with conn: conn.executemany(...)`.
+    """
+    def __init__(self, writer: 'WriteQueue') -> None:
+        self.writer = writer
+        self.statements = []  # type: Statements
+
+    def execute(self, sql: str, params: Sequence[Any]=()) -> None:
+        self.statements.append((sql, [params]))
+
+    def executemany(self, sql: str, rows: Iterable[Sequence[Any]]) -> None:
+        self.statements.append((sql, list(rows)))
+
+    def __enter__(self) -> 'Transaction':
+        return self
+
+    def __exit__(self, exc_type, *_exc_info) -> None:
+        if exc_type is None and self.statements:
+            self.writer.submit(self.statements)
+
+
+class WriteQueue:
+    """
+    The one writer of a database: a thread that owns the only writing
+    connection, and commits the transactions put on its queue, several at
+    a time, once batch_size rows have piled up or interval seconds have
+    passed. Transactions are never split across commits.
+
+    The queue is a multiprocessing.Queue, so processes forked after the
+    WriteQueue is created can submit to it too. Use as a context manager,
+    or call close(), to commit whatever is left.
+    """
+    def __init__(self, path: str=DATABASE, *, batch_size: int=1000,
+                 interval: float=1.0, maxsize: int=256) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = multiprocessing.Queue(
+            maxsize)  # type: multiprocessing.Queue[Optional[Statements]]
+        self._error = None  # type: Optional[BaseException]
+        self._thread = threading.Thread(target=self._run, name='writer',
+                                        daemon=True)
+        self._thread.start()
+
+    def transaction(self) -> Transaction:
+        return Transaction(self)
+
+    def submit(self, statements: Statements) -> None:
+        self._check()
+        self._queue.put(statements)
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._check()
+
+    def __enter__(self) -> 'WriteQueue':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _check(self) -> None:
+        if self._error is not None:
+            raise RuntimeError('Writing to the database failed') from self._error
+
+    def _run(self) -> None:
+        conn = connect(self.path)
+        pending = []  # type: List[Statements]
+        rows = 0
+        last_commit = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.interval)
+            except queue.Empty:
+                item = []
+            if item is None:
+                break
+            if item:
+                pending.append(item)
+                rows += sum(len(batch) for _sql, batch in item)
+            if pending and (rows >= self.batch_size or
+                            time.monotonic() - last_commit >= self.interval):
+                self._commit(conn, pending)
+                pending, rows = [], 0
+                last_commit = time.monotonic()
+        self._commit(conn, pending)
+        conn.close()
+
+    def _commit(self, conn: sqlite3.Connection,
+                transactions: List[Statements]) -> None:
+        # After a failure, keep draining the queue so producers don't
+        # block; the error is raised on their next submit().
+        if self._error is not None or not transactions:
+            return
+        try:
+            with conn:
+                for statements in transactions:
+                    for sql, rows in statements:
+                        conn.executemany(sql, rows)
+        except BaseException as error:
+            self._error = error
+
+
+def transaction(conn: sqlite3.Connection,
+                writer: Optional[WriteQueue]=None
+                ) -> Union[sqlite3.Connection, Transaction]:
+    """
+    Something to write a transaction to: the writer if there is one, or
+    else the connection itself.
+    """
+    return writer.transaction() if writer is not None else conn
+
+
+def _write_from_child(writer: WriteQueue, values: List[int]) -> None:
+    with writer.transaction() as tx:
+        tx.executemany('INSERT INTO t VALUES (?)', [(v,) for v in values])
+
+
+def test_write_queue(tmpdir) -> None:
+    path = str(tmpdir.join('test.sqlite3'))
+    conn = connect(path)
+    assert conn.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    conn.execute('CREATE TABLE t(x INT)')
+    conn.commit()
+
+    with WriteQueue(path, batch_size=10, interval=0.05) as writer:
+        threads = [threading.Thread(target=_write_from_child,
+                                    args=(writer, list(range(i, i + 5))))
+                   for i in range(0, 50, 5)]
+        for thread in threads:
+            thread.start()
+        child = multiprocessing.get_context('fork').Process(
+            target=_write_from_child, args=(writer, [100, 101])
+        )
+        child.start()
+        child.join()
+        for thread in threads:
+            thread.join()
+    assert (conn.execute('SELECT COUNT(*), SUM(x) FROM t').fetchone() ==
+            (52, sum(range(50)) + 201))
+
+
+def test_write_queue_error(tmpdir) -> None:
+    path = str(tmpdir.join('test.sqlite3'))
+    writer = WriteQueue(path, batch_size=1)
+    with writer.transaction() as tx:
+        tx.execute('INSERT INTO nonexistent VALUES (1)')
+    try:
+        writer.close()
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'expected the failed write to be reported'
@@ -19,8 +19,14 @@
 Determines the Levenshtein distance between two source files.
 """
 
+import argparse
+import logging
 import sqlite3
-from typing import Iterable, Iterator, NewType, Optional, Tuple, cast
+from collections import Counter
+from contextlib import ExitStack
+from typing import (
+    Dict, Iterable, Iterator, List, NewType, Optional, Tuple, cast
+)
 
 from Levenshtein import distance, editops  # type: ignore
 
@@ -31,15 +37,15 @@ except ImportError:
     def tqdm(it, *_args, **_kwargs):
         yield from it
 
-from java import java, java2sensibility
-from lexical_analysis import Lexeme
+from alignment import EditOp, bounded_distance, bounded_editops
+from database import DATABASE, WriteQueue, connect
+from java import RESERVED_WORDS_REPR, java, java2sensibility, vind_encoder
+from java import JavaError, JavaPool
+from lexical_analysis import Lexeme, TokenStream
 from vocabulary import vocabulary, Vind
-from mistakes import Mistakes, Mistake
+from mistakes import Mistakes, Mistake, Revision
 from mistakes import Edit, EditType, Insertion, Deletion, Substitution
-
-
-# Supplementary Private Use Area B
-PUA_B_START = 0x100000
+from token_store import PUA_B_START, TokenSequence, TokenStore
 
 
 def to_edit_type(name: str) -> EditType:
@@ -65,6 +71,14 @@ def tokens2seq(tokens: Iterable[Lexeme],
     # use area.
     # distance() works on codepoints, so this effectively makes distance()
     # work on token classes.
+    if to_index == vocabulary.to_index and to_entry is java2sensibility:
+        if isinstance(tokens, TokenStream):
+            # The stream has already looked up every token's index.
+            vinds = tokens.vinds  # type: Iterable[int]
+        else:
+            vinds = (vind_encoder.encode(token.name, token.value)
+                     for token in tokens)
+        return ''.join(chr(PUA_B_START + vind) for vind in vinds)
     return ''.join(
         chr(PUA_B_START + to_index(to_entry(token)))
         for token in tokens
@@ -86,11 +100,16 @@ class FixEvent:
     A fix event is a collection of the edit that converts a file from good
     syntax to syntax error (the edit); from bad syntax to good syntax (the
     fix); and the line number of the token affected.
+
+    The edit's position is in the good file; source_position is the
+    position of the same token in the bad file, on line line_no.
     """
-    def __init__(self, edit: Edit, fix: Edit, line_no: int) -> None:
+    def __init__(self, edit: Edit, fix: Edit, line_no: int,
+                 source_position: Optional[int]=None) -> None:
         self.edit = edit
         self.fix = fix
         self.line_no = line_no
+        self.source_position = source_position
 
 
 def determine_edit(file_a: bytes, file_b: bytes) -> Edit:
@@ -102,19 +121,44 @@ def determine_fix_event(file_a: bytes, file_b: bytes) -> FixEvent:
     For two source files with Levenshtein distance of one, this returns the
     edit that converts the first file into the second file.
     """
-    src = tokens2seq(java.tokenize(file_a))
-    dest = tokens2seq(java.tokenize(file_b))
-    ops = editops(src, dest)
+    return fix_event_of(TokenSequence.lex(file_a), TokenSequence.lex(file_b))
+
+
+def fix_event_of(src_tokens: TokenSequence,
+                 dest_tokens: TokenSequence) -> FixEvent:
+    """
+    Like determine_fix_event(), but for already lexed files.
+    """
+    ops = editops(src_tokens.to_pua(), dest_tokens.to_pua())
     # This only works for files with one edit!
     assert len(ops) == 1
+    return to_fix_event(ops[0], src_tokens, dest_tokens)
 
-    # Decode editop's format.
-    (type_name, src_pos, dest_pos), = ops
+
+def determine_fix_events(src_tokens: TokenSequence,
+                         dest_tokens: TokenSequence,
+                         max_edits: int) -> Optional[List[FixEvent]]:
+    """
+    Returns every edit that converts the first file into the second file,
+    or None if that takes more than max_edits edits.
+    """
+    ops = bounded_editops(src_tokens.to_pua(), dest_tokens.to_pua(),
+                          max_edits)
+    if ops is None:
+        return None
+    return [to_fix_event(op, src_tokens, dest_tokens) for op in ops]
+
+
+def to_fix_event(op: EditOp, src_tokens: TokenSequence,
+                 dest_tokens: TokenSequence) -> FixEvent:
+    """
+    Decodes an editop into a FixEvent.
+    """
+    type_name, src_pos, dest_pos = op
     edit_type = to_edit_type(type_name)
-    new_token = None if edit_type is Deletion else from_pua(dest[dest_pos])
+    new_token = None if edit_type is Deletion else dest_tokens[dest_pos]
     edit = Edit(edit_type, dest_pos, new_token)
-
-    return FixEvent(edit, edit, 0)
+    return FixEvent(edit, edit, src_tokens.line_of(src_pos), src_pos)
 
 
 def index_of(token: str) -> Vind:
@@ -150,6 +194,58 @@ def test_extra() -> None:
     assert 1 == tokenwise_distance(b'goto label;', b'int label;')
 
 
+def test_token_stream() -> None:
+    stream = java.tokenize(b'class Hello {\n  int x = 1;\n}')
+    views = list(stream)
+    assert [token.value for token in views][:3] == ['class', 'Hello', '{']
+    assert (views[4].name, views[4].line, views[4].column) == ('IDENTIFIER',
+                                                               2, 6)
+    # Reading the arrays is the same as reading every token.
+    assert tokens2seq(stream) == tokens2seq(views)
+    assert ([entry for _, entry in java.vocabularize_tokens(stream)] ==
+            [entry for _, entry in java.vocabularize_tokens(views)])
+    assert ([loc.end for loc, _ in java.vocabularize_tokens(stream)] ==
+            [token.end for token in views])
+
+
+def test_token_stream_from_pool() -> None:
+    source = b'class Hello {\n  while (true) { x += 1.0f; }\n}'
+    expected = [token.name for token in java.tokenize(source)]
+    with JavaPool(1, stagger=0) as pool:
+        # Workers have their own kind numbering; pretend this process has
+        # yet to see any kinds at all.
+        names, ids = TokenStream.kind_names, TokenStream._kind_ids
+        TokenStream.kind_names, TokenStream._kind_ids = [], {}
+        java.pool = pool
+        try:
+            stream, = java.tokenize_many([source])
+            assert not isinstance(stream, JavaError), stream
+            assert [token.name for token in stream] == expected
+        finally:
+            java.pool = None
+            TokenStream.kind_names, TokenStream._kind_ids = names, ids
+
+
+def test_vind_encoder() -> None:
+    for value in RESERVED_WORDS_REPR:
+        lexeme = Lexeme(name=value.upper(), value=value)
+        assert (vind_encoder.encode(lexeme.name, lexeme.value) ==
+                vocabulary.to_index(java2sensibility(lexeme)))
+    for name, value in [('IDENTIFIER', 'x'), ('STRINGLITERAL', '"x"'),
+                        ('CHARLITERAL', "'{'"), ('LONGLITERAL', '1L'),
+                        ('LBRACE', '{'), ('ELLIPSIS', '...')]:
+        assert (vind_encoder.encode(name, value) ==
+                vocabulary.to_index(java2sensibility(Lexeme(name=name,
+                                                            value=value))))
+    # Out of vocabulary: counted, rather than warned about each time.
+    vocabulary.unknown.clear()
+    assert vind_encoder.encode('ERROR', '#') == vocabulary.unk_token_index
+    assert vind_encoder.encode('UNDERSCORE', '_') == vocabulary.unk_token_index
+    assert vind_encoder.encode('UNDERSCORE', '_') == vocabulary.unk_token_index
+    assert vocabulary.unknown == {'_': 2}
+    vocabulary.unknown.clear()
+
+
 def _test_get_source() -> None:
     m = Mistakes(sqlite3.connect('java-mistakes.sqlite3'))
     mistake = next(iter(m))
@@ -173,11 +269,180 @@ def test_get_edit() -> None:
     assert sub.new_token == index_of('int')
 
 
+def test_fix_events() -> None:
+    before = TokenSequence.lex(b'class Hello {\n  int x = \n}')
+    after = TokenSequence.lex(b'class Hello {\n  int x = 1;\n}')
+    assert determine_fix_events(before, after, 1) is None
+    events = determine_fix_events(before, after, 2)
+    assert events is not None
+    assert [e.edit.type for e in events] == [Insertion, Insertion]
+    assert [e.edit.new_token for e in events] == [index_of('<INTLITERAL>'),
+                                                  index_of(';')]
+    assert [e.edit.position for e in events] == [6, 7]
+    assert [e.source_position for e in events] == [6, 6]
+    assert [e.line_no for e in events] == [3, 3]
+
+
+def test_fix_event_line_no() -> None:
+    event = determine_fix_event(b'class Hello {\n  int x\n}',
+                                b'class Hello {\n  int x;\n}')
+    assert event.line_no == 3
+
+
+class Measurement:
+    """
+    The distance between the before and after of a mistake (None if more
+    than the maximum), and its edits, if it has few enough.
+    """
+    __slots__ = 'mistake', 'distance', 'events'
+
+    def __init__(self, mistake: Mistake, distance: Optional[int],
+                 events: Optional[List[FixEvent]]) -> None:
+        self.mistake = mistake
+        self.distance = distance
+        self.events = events
+
+
+def measure(mistake: Mistake, before: TokenSequence, after: TokenSequence,
+            max_distance: Optional[int],
+            max_edits: Optional[int]) -> Measurement:
+    if max_distance is None:
+        dist = distance(before.to_pua(), after.to_pua())  # type: Optional[int]
+    else:
+        dist = bounded_distance(before.to_pua(), after.to_pua(), max_distance)
+    events = None
+    if max_edits is not None and dist is not None and 0 < dist <= max_edits:
+        events = determine_fix_events(before, after, dist)
+    return Measurement(mistake, dist, events)
+
+
+# One connection per process, opened on first use.
+_connections = {}  # type: Dict[str, sqlite3.Connection]
+
+
+def measure_range(path: str, rowids: Tuple[int, int],
+                  max_distance: Optional[int], max_edits: Optional[int]
+                  ) -> Tuple[List[Measurement],
+                             List[Tuple[Revision, TokenSequence]], Counter]:
+    """
+    Measures every mistake in the range of rowids that doesn't have a
+    distance yet. Only reads the database: returns the measurements, and
+    the token sequences that had to be lexed, for the caller to store; and
+    the tokens converted to <unk> while lexing, for the caller to report.
+    Meant to run in a JavaPool worker.
+    """
+    if path not in _connections:
+        _connections[path] = connect(path)
+    conn = _connections[path]
+    store = TokenStore(conn, read_only=True)
+    mistakes = list(Mistakes(conn).without_distance(rowids))
+    # Lex whatever isn't stored in one batch. Sources are only read from
+    # the database if they need lexing.
+    tokens = store.tokens_of_many([
+        (revision, source)
+        for mistake in mistakes
+        for revision, source in (
+            (mistake.before_revision, lambda m=mistake: m.before),
+            (mistake.after_revision, lambda m=mistake: m.after),
+        )
+    ])
+    results = []
+    for mistake, before, after in zip(mistakes, tokens[::2], tokens[1::2]):
+        if isinstance(before, JavaError) or isinstance(after, JavaError):
+            # Left without a distance, to be tried again next time.
+            error = before if isinstance(before, JavaError) else after
+            logging.getLogger('distance').error('Could not lex %s: %s',
+                                                mistake, error)
+        else:
+            results.append(measure(mistake, before, after,
+                                   max_distance, max_edits))
+        # No need to send the sources back.
+        mistake.before = mistake.after = b''
+    unknown = vocabulary.unknown.copy()
+    vocabulary.unknown.clear()
+    return results, store.unsaved, unknown
+
+
+def record(mistakes: Mistakes, store: TokenStore,
+           results: Iterable[Measurement],
+           lexed: Iterable[Tuple[Revision, TokenSequence]],
+           max_distance: Optional[int]) -> None:
+    for revision, tokens in lexed:
+        store.put(revision, tokens)
+    for result in results:
+        mistake = result.mistake
+        if result.distance is None:
+            mistakes.insert_distance(mistake, f'>{max_distance}')
+        else:
+            mistakes.insert_distance(mistake, result.distance)
+        if result.events is not None:
+            mistakes.insert_fix_events(mistake, result.events)
+            if len(result.events) == 1:
+                event, = result.events
+                mistakes.insert_edit(mistake, event.edit, event.fix,
+                                     event.line_no)
+
+
+parser = argparse.ArgumentParser(description='Populate the distance table')
+parser.add_argument('--max-distance', type=int, metavar='K',
+                    help='only compute distances up to K; larger ones are '
+                         'stored as ">K" (much faster)')
+parser.add_argument('--find-edits', action='store_true',
+                    help='also populate the edit table, in the same pass, '
+                         'rather than running find_edit.py afterwards')
+parser.add_argument('--max-edits', type=int, default=1, metavar='N',
+                    help='with --find-edits, also store every edit of pairs '
+                         'with up to N edits in the edits table '
+                         '(default: %(default)s)')
+parser.add_argument('--batch-size', type=int, default=1000,
+                    help='rows to write per transaction '
+                         '(default: %(default)s)')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of processes lexing and measuring, each '
+                         'with its own Java server (default: %(default)s)')
+parser.add_argument('--chunk-size', type=int, default=1000,
+                    help='rowids of the mistake table handed to a worker '
+                         'at a time (default: %(default)s)')
+
+
 if __name__ == '__main__':
-    conn = sqlite3.connect('java-mistakes.sqlite3')
-    # HACK! Make writes super speedy by disregarding durability.
-    conn.execute('PRAGMA synchronous = OFF')
-    mistakes = Mistakes(conn)
-    for mistake in tqdm(mistakes):
-        dist = tokenwise_distance(mistake.before, mistake.after)
-        mistakes.insert_distance(mistake, dist)
+    args = parser.parse_args()
+    max_edits = args.max_edits if args.find_edits else None
+    conn = connect()
+    ranges = list(Mistakes(conn).rowid_ranges(args.chunk_size))
+
+    # Rows that already have a distance are skipped, so an interrupted run
+    # picks up where it left off.
+    with ExitStack() as stack:
+        # Fork the workers before the writer thread starts: a fork while
+        # it's inside SQLite could leave the children with its locks held.
+        pool = None
+        if args.workers > 1:
+            pool = stack.enter_context(JavaPool(args.workers))
+        # Closed after the others, to commit whatever they flush on exit.
+        writer = stack.enter_context(
+            WriteQueue(DATABASE, batch_size=args.batch_size)
+        )
+        mistakes = stack.enter_context(
+            Mistakes(conn, batch_size=args.batch_size, writer=writer)
+        )
+        store = stack.enter_context(
+            TokenStore(conn, batch_size=args.batch_size, writer=writer)
+        )
+        if pool is not None:
+            measured = pool.map_ordered(
+                measure_range, ranges,
+                args=lambda rowids: (DATABASE, rowids,
+                                     args.max_distance, max_edits)
+            )
+        else:
+            measured = ((rowids, measure_range(DATABASE, rowids,
+                                               args.max_distance, max_edits))
+                        for rowids in ranges)
+        # This process (well, its writer thread) is the one and only writer.
+        for _rowids, (results, lexed, unknown) in tqdm(measured,
+                                                       total=len(ranges),
+                                                       unit='chunk'):
+            vocabulary.unknown.update(unknown)
+            record(mistakes, store, results, lexed, args.max_distance)
+    vocabulary.warn_unknown()
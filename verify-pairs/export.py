@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright 2017 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Exports the mistake corpus as columns: a directory of .npy files that can be
+memory-mapped, so that loading a million mistakes takes no per-mistake
+Python objects at all.
+
+    source_file_id, before_id, after_id     int64[n]
+    distance                                int32[n]; -1 if unknown or over
+                                            the maximum distance computed
+    before_tokens, after_tokens             uint8[total tokens]: Vinds
+    before_offsets, after_offsets           int64[n + 1]: mistake i's
+                                            tokens are tokens[offsets[i]:
+                                            offsets[i + 1]]
+    edit_offsets                            int64[n + 1], into...
+    edit_type                               uint8[total edits]: ord('i'),
+                                            ord('x'), or ord('s')
+    edit_position, edit_before_position,
+    edit_line_no                            int32[total edits]
+    edit_new_token                          int16[total edits]; -1 if none
+    vocabulary.txt                          the entry of each Vind, by line
+
+Edits come from the edits table (distance.py --find-edits) or, if that is
+empty, from the edit table (find_edit.py), which has one edit per mistake.
+
+Use load() to read it back.
+"""
+
+import argparse
+import os
+import sqlite3
+from array import array
+from typing import Any, BinaryIO, Dict, List, Tuple
+
+try:
+    import numpy as np  # type: ignore
+except ImportError:
+    np = None  # type: ignore
+
+# Use tqdm only if it's installed.
+try:
+    from tqdm import tqdm  # type: ignore
+except ImportError:
+    def tqdm(it, *_args, **_kwargs):
+        yield from it
+
+from database import DATABASE, connect
+from mistakes import Edit, Insertion, Mistake, Mistakes
+from token_store import TokenStore
+from vocabulary import Vind, vocabulary
+
+# Name of each column, and its type (as an array typecode, and for numpy).
+COLUMNS = [
+    ('source_file_id', 'q'),
+    ('before_id', 'q'),
+    ('after_id', 'q'),
+    ('distance', 'i'),
+    ('before_tokens', 'B'),
+    ('after_tokens', 'B'),
+    ('before_offsets', 'q'),
+    ('after_offsets', 'q'),
+    ('edit_offsets', 'q'),
+    ('edit_type', 'B'),
+    ('edit_position', 'i'),
+    ('edit_before_position', 'i'),
+    ('edit_line_no', 'i'),
+    ('edit_new_token', 'h'),
+]
+DTYPES = {'q': '<i8', 'i': '<i4', 'h': '<i2', 'B': 'u1'}
+
+
+class ColumnWriter:
+    """
+    Appends values to a column on disk, without keeping them in memory.
+    Columns are written raw, then wrapped as .npy files by finish().
+    """
+    def __init__(self, directory: str, name: str, typecode: str) -> None:
+        self.path = os.path.join(directory, name)
+        self.typecode = typecode
+        self.file = open(self.path + '.raw', 'wb')  # type: BinaryIO
+        self.buffer = array(typecode)
+
+    def extend(self, values) -> None:
+        self.buffer.extend(values)
+        if len(self.buffer) >= 1 << 16:
+            self.flush()
+
+    def flush(self) -> None:
+        self.buffer.tofile(self.file)
+        del self.buffer[:]
+
+    def finish(self) -> None:
+        self.flush()
+        self.file.close()
+        raw = self.path + '.raw'
+        dtype = np.dtype(DTYPES[self.typecode])
+        if os.path.getsize(raw) == 0:
+            np.save(self.path + '.npy', np.zeros(0, dtype=dtype))
+        else:
+            # Copied a page at a time by numpy; never all in memory.
+            np.save(self.path + '.npy', np.memmap(raw, dtype=dtype, mode='r'))
+        os.remove(raw)
+
+
+def export(conn: sqlite3.Connection, directory: str) -> int:
+    """
+    Writes every mistake to the directory, and returns how many there were.
+    Token sequences come from the tokens table, or are lexed (and stored)
+    if missing.
+    """
+    os.makedirs(directory, exist_ok=True)
+    columns = {name: ColumnWriter(directory, name, typecode)
+               for name, typecode in COLUMNS}
+    mistakes = Mistakes(conn)
+    store = TokenStore(conn)
+    offsets = {'before': 0, 'after': 0, 'edit': 0}
+    for name in offsets:
+        columns[name + '_offsets'].extend([0])
+
+    if conn.execute('SELECT 1 FROM edits LIMIT 1').fetchone() is not None:
+        edits_query = '''
+            SELECT edit, position, before_position, line_no, new_token
+              FROM edits
+             WHERE source_file_id = ? AND before_id = ?
+             ORDER BY n
+        '''
+    else:
+        # find_edit.py only handles one edit, so the fix's position is the
+        # same in the bad file as in the good file.
+        edits_query = '''
+            SELECT fix, fix_position, fix_position, line_no, fix_new_token
+              FROM edit
+             WHERE source_file_id = ? AND before_id = ?
+        '''
+
+    rows = conn.execute('''
+        SELECT mistake.rowid, source_file_id, before_id, after_id, levenshtein
+        FROM mistake LEFT JOIN distance USING (source_file_id, before_id)
+        ORDER BY mistake.rowid
+    ''')
+    count = 0
+    for rowid, sfid, meid, after_id, distance in tqdm(rows, unit='mistake'):
+        mistake = Mistake(sfid, meid, None, None, after_id,
+                          rowid=rowid, database=mistakes)
+        columns['source_file_id'].extend([sfid])
+        columns['before_id'].extend([meid])
+        columns['after_id'].extend([after_id])
+        columns['distance'].extend([
+            distance if isinstance(distance, int) else -1
+        ])
+
+        for side, revision in (('before', mistake.before_revision),
+                               ('after', mistake.after_revision)):
+            tokens = store.tokens_of(
+                revision, lambda: getattr(mistake, side)
+            )
+            columns[side + '_tokens'].extend(tokens.vinds)
+            offsets[side] += len(tokens)
+            columns[side + '_offsets'].extend([offsets[side]])
+
+        edits = conn.execute(edits_query, (sfid, meid)).fetchall()
+        for edit, position, before_position, line_no, new_token in edits:
+            columns['edit_type'].extend([ord(edit)])
+            columns['edit_position'].extend([position])
+            columns['edit_before_position'].extend([before_position])
+            columns['edit_line_no'].extend([line_no])
+            # The edit table has TEXT affinity, so Vinds come back as str.
+            columns['edit_new_token'].extend([
+                -1 if new_token is None else int(new_token)
+            ])
+        offsets['edit'] += len(edits)
+        columns['edit_offsets'].extend([offsets['edit']])
+        count += 1
+
+    store.flush()
+    for column in columns.values():
+        column.finish()
+    with open(os.path.join(directory, 'vocabulary.txt'), 'w') as entries:
+        for index in range(len(vocabulary)):
+            entries.write(vocabulary.to_text(Vind(index)) + '\n')
+    return count
+
+
+def load(directory: str) -> Dict[str, Any]:
+    """
+    Memory-maps every column of an export; plus the list of vocabulary
+    entries, as 'vocabulary'.
+    """
+    corpus = {
+        name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+        for name, _typecode in COLUMNS
+    }  # type: Dict[str, Any]
+    with open(os.path.join(directory, 'vocabulary.txt')) as entries:
+        corpus['vocabulary'] = entries.read().splitlines()
+    return corpus
+
+
+def tokens(corpus: Dict[str, Any], side: str, index: int):
+    """
+    The Vinds of the before or after of the index-th mistake, as a view.
+    """
+    offsets = corpus[side + '_offsets']
+    return corpus[side + '_tokens'][offsets[index]:offsets[index + 1]]
+
+
+def _test_database() -> sqlite3.Connection:
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''
+        CREATE TABLE mistake (
+            source_file_id  INT,
+            before_id       INT,
+            after_id        INT,
+            before          BLOB,
+            after           BLOB,
+            PRIMARY KEY (source_file_id, before_id)
+        )
+    ''')
+    conn.executemany('INSERT INTO mistake VALUES (?, ?, ?, ?, ?)', [
+        (1, 1, 2, b'class A {', b'class A { }'),
+        (1, 3, 4, b'class B { int x }', b'class B { int x; }'),
+    ])
+    return conn
+
+
+def test_export(tmpdir) -> None:
+    import pytest  # type: ignore
+    pytest.importorskip('numpy')
+    conn = _test_database()
+    mistakes = Mistakes(conn)
+    first, second = mistakes
+    mistakes.insert_distance(first, 1)
+    mistakes.insert_distance(second, '>0')
+    conn.execute('''
+        INSERT INTO edits VALUES (1, 1, 0, 'i', 3, 3, 39, 1)
+    ''')
+
+    assert export(conn, str(tmpdir)) == 2
+    corpus = load(str(tmpdir))
+    assert list(corpus['before_id']) == [1, 3]
+    assert list(corpus['distance']) == [1, -1]
+    assert list(corpus['before_offsets']) == [0, 3, 9]
+    assert list(corpus['after_offsets']) == [0, 4, 11]
+    assert ([corpus['vocabulary'][v] for v in tokens(corpus, 'before', 1)] ==
+            ['class', '<IDENTIFIER>', '{', 'int', '<IDENTIFIER>', '}'])
+    assert list(corpus['edit_offsets']) == [0, 1, 1]
+    assert chr(corpus['edit_type'][0]) == 'i'
+    assert list(corpus['edit_new_token']) == [39]
+
+
+def test_export_find_edit(tmpdir) -> None:
+    import pytest  # type: ignore
+    pytest.importorskip('numpy')
+    conn = _test_database()
+    # As find_edit.py leaves it: the edit table, and no edits.
+    with Mistakes(conn) as mistakes:
+        first, _second = mistakes
+        mistakes.insert_edit(first, Edit(Insertion, 3, Vind(39)), line_no=1)
+
+    assert export(conn, str(tmpdir)) == 2
+    corpus = load(str(tmpdir))
+    assert list(corpus['edit_offsets']) == [0, 1, 1]
+    assert chr(corpus['edit_type'][0]) == 'i'
+    assert list(corpus['edit_position']) == [3]
+    assert list(corpus['edit_before_position']) == [3]
+    assert list(corpus['edit_line_no']) == [1]
+    assert list(corpus['edit_new_token']) == [39]
+
+
+parser = argparse.ArgumentParser(
+    description='Export mistakes as memory-mappable .npy columns')
+parser.add_argument('directory')
+parser.add_argument('--database', default=DATABASE)
+
+
+if __name__ == '__main__':
+    if np is None:
+        raise SystemExit('Please install numpy')
+    args = parser.parse_args()
+    count = export(connect(args.database), args.directory)
+    vocabulary.warn_unknown()
+    print(f"Exported {count} mistakes to {args.directory}")
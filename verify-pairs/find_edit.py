@@ -19,7 +19,6 @@
 Finds edits and inserts them into the database.
 """
 
-import sqlite3
 import logging
 
 # Use tqdm only if it's installed.
@@ -31,19 +30,29 @@ except ImportError:
 
 from mistakes import Mistakes, Mistake
 from mistakes import Edit, EditType, Insertion, Deletion, Substitution
-from distance import determine_fix_event
+from distance import fix_event_of
+from database import WriteQueue, connect
+from token_store import TokenStore
+from vocabulary import vocabulary
 
 
 if __name__ == '__main__':
     logger = logging.getLogger('find_edit')
     logging.basicConfig(filename="find_edit.log")
-    conn = sqlite3.connect('java-mistakes.sqlite3')
-    # HACK! Make writes super speedy by disregarding durability.
-    conn.execute('PRAGMA synchronous = OFF')
-    mistakes = Mistakes(conn)
-    for mistake in tqdm(mistakes.eligible_mistakes):
-        try:
-            edit = determine_fix_event(mistake.before, mistake.after).edit
-        except Exception:
-            logger.exception('Error determining distance of %s', mistake)
-        mistakes.insert_edit(mistake, edit)
+    conn = connect()
+    # Tokens were stored by distance.py; only lex what's missing.
+    with WriteQueue() as writer, \
+            Mistakes(conn, batch_size=1000, writer=writer) as mistakes, \
+            TokenStore(conn, writer=writer) as store:
+        for mistake in tqdm(mistakes.eligible_mistakes):
+            try:
+                before = store.tokens_of(mistake.before_revision,
+                                         lambda: mistake.before)
+                after = store.tokens_of(mistake.after_revision,
+                                        lambda: mistake.after)
+                event = fix_event_of(before, after)
+            except Exception:
+                logger.exception('Error determining distance of %s', mistake)
+                continue
+            mistakes.insert_edit(mistake, event.edit, event.fix, event.line_no)
+    vocabulary.warn_unknown()
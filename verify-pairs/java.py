@@ -15,22 +15,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import multiprocessing
 import os
 import sys
+import time
 import token
+from collections import deque
 from io import BytesIO
 from keyword import iskeyword
 from pathlib import Path
 from typing import (
-    Any, AnyStr, Callable, IO, Iterable, Optional, Tuple, Union,
-    overload,
+    Any, AnyStr, Callable, Dict, IO, Iterable, Iterator, List, Optional,
+    Sequence, Tuple, TypeVar, Union, cast, overload,
 )
 
-from lexical_analysis import Lexeme, Location, Position, Token
+from lexical_analysis import Lexeme, Location, Position, Token, TokenStream
+from syntax_cache import SyntaxCache
+from vocabulary import Vind, Vocabulary, vocabulary
 
 import javac_parser
 
 
+class JavaError(Exception):
+    """
+    Loading, lexing or parsing one source failed. Batch methods return this
+    in place of that source's result, rather than failing the whole batch.
+    """
+
+
 class Java:
     """
     Defines the Java 8 programming language.
@@ -38,6 +50,11 @@ class Java:
 
     extensions = {'.java'}
 
+    # If set, consulted before asking the Java server to parse anything.
+    syntax_cache = None  # type: Optional[SyntaxCache]
+    # If set, parsing happens in these worker processes instead.
+    pool = None  # type: Optional[JavaPool]
+
     @property
     def java(self):
         """
@@ -51,8 +68,24 @@ class Java:
 
         return self._java_server
 
-    def tokenize(self, source: Union[str, bytes, IO[bytes]]) -> Iterable[Token]:
-        tokens = self.java.lex(to_str(source))
+    def tokenize(self, source: Union[str, bytes, IO[bytes]]) -> TokenStream:
+        return self._to_stream(self.java.lex(to_str(source)))
+
+    def tokenize_many(self, sources: Iterable[Union[str, bytes]]
+                      ) -> List[Union[TokenStream, JavaError]]:
+        """
+        Tokenizes every source, in one trip to the pool (if any). Each
+        source that can't be tokenized gets a JavaError instead.
+        """
+        sources = list(sources)
+        if self.pool is not None:
+            return self.pool.apply(_tokenize_many, (sources,))
+        return _tokenize_many(sources)
+
+    def _to_stream(self, tokens: Iterable[Tuple]) -> TokenStream:
+        stream = TokenStream()
+        by_value = vind_encoder.by_value.get
+        by_kind = vind_encoder.by_kind.get
         # Each token is a tuple with the following structure
         # (reproduced from javac_parser.py):
         #   1. Lexeme type
@@ -66,16 +99,95 @@ class Java:
                 continue
             # Take the NORMALIZED value, as Java allows unicode escapes in
             # ARBITRARY tokens and then things get hairy here.
-            yield Token(name=name, value=normalized,
-                        start=Position(line=start[0], column=start[1]),
-                        end=Position(line=end[0], column=end[1]))
+            # VindEncoder.encode(), inlined, as this is once per token.
+            vind = by_value(normalized)
+            if vind is None:
+                vind = by_kind(name)
+                if vind is None:
+                    vind = vind_encoder.encode(name, normalized)
+            stream.append(name, normalized, vind, start, end)
+        return stream
 
     def check_syntax(self, source: Union[str, bytes]) -> bool:
-        return self.java.get_num_parse_errors(to_str(source)) == 0
+        return self.num_parse_errors(source) == 0
+
+    def check_syntax_many(self, sources: Iterable[Union[str, bytes]]
+                          ) -> List[Union[bool, JavaError]]:
+        """
+        check_syntax() of every source; or a JavaError for each source that
+        can't be parsed.
+        """
+        return [errors if isinstance(errors, JavaError) else errors == 0
+                for errors in self.num_parse_errors_many(sources)]
+
+    def num_parse_errors(self, source: Union[str, bytes]) -> int:
+        """
+        Parses the source, unless its number of parse errors is already in
+        the syntax cache.
+        """
+        cache = self.syntax_cache
+        if cache is not None:
+            errors = cache.get(source)
+            if errors is not None:
+                return errors
+
+        if self.pool is not None:
+            errors = self.pool.apply(_num_parse_errors, (source,))
+        else:
+            errors = _num_parse_errors(source)
+
+        if cache is not None:
+            cache.put(source, errors)
+        return errors
+
+    def num_parse_errors_many(self, sources: Iterable[Union[str, bytes]]
+                              ) -> List[Union[int, JavaError]]:
+        """
+        num_parse_errors() of every source, with all those missing from the
+        syntax cache parsed in one trip to the pool (if any). Each source
+        that can't be parsed gets a JavaError instead.
+        """
+        sources = list(sources)
+        results = [None] * len(sources)  # type: List[Any]
+        cache = self.syntax_cache
+        if cache is not None:
+            results = [cache.get(source) for source in sources]
+        misses = [i for i, errors in enumerate(results) if errors is None]
+        if not misses:
+            return results
+
+        to_parse = [sources[i] for i in misses]
+        if self.pool is not None:
+            parsed = self.pool.apply(_num_parse_errors_many, (to_parse,))
+        else:
+            parsed = _num_parse_errors_many(to_parse)
+
+        for i, errors in zip(misses, parsed):
+            results[i] = errors
+            if cache is not None and not isinstance(errors, JavaError):
+                cache.put(sources[i], errors)
+        return results
 
     def vocabularize_tokens(self, source: Iterable[Token]) -> Iterable[Tuple[Location, str]]:
-        for token in source:
-            yield token.location, java2sensibility(token)
+        if not isinstance(source, TokenStream):
+            for token in source:
+                yield token.location, java2sensibility(token)
+            return
+
+        # Read the entries straight from the stream's Vinds; only <ERROR>
+        # (and anything else out of vocabulary) needs its token.
+        unk = vocabulary.unk_token_index
+        vinds = cast(Sequence[Vind], source.vinds)
+        for index, vind in enumerate(vinds):
+            start = Position(line=source.start_lines[index],
+                             column=source.start_columns[index])
+            end = Position(line=source.end_lines[index],
+                           column=source.end_columns[index])
+            if vind == unk:
+                entry = java2sensibility(source[index])
+            else:
+                entry = vocabulary.to_text(vind)
+            yield Location(start=start, end=end), entry
 
 
 # Big list of symbol names, derived from
@@ -150,28 +262,76 @@ def java2sensibility(lex: Lexeme) -> str:
 
     Other closed classes are represented by their in-source value.
     """
+    return sensibility(lex.name, lex.value)
+
+
+def sensibility(name: str, value: str) -> str:
+    """
+    java2sensibility() of a lexeme's name and value, without the lexeme.
+    """
     # > Except for comments (§3.7), identifiers, and the contents of character
     # > and string literals (§3.10.4, §3.10.5), all input elements (§3.5) in a
     # > program are formed only from ASCII characters (or Unicode escapes (§3.3)
     # > which result in ASCII characters).
     # https://docs.oracle.com/javase/specs/jls/se7/html/jls-3.html
-    if lex.value in REPRESENTABLE_CLOSED_CLASSES:
-        return lex.value
-    elif lex.name in OPEN_CLASSES:
-        if lex.name in NUMERIC_LITERALS:
-            return f'<{lex.name}>'
-        elif lex.name == 'STRINGLITERAL':
+    if value in REPRESENTABLE_CLOSED_CLASSES:
+        return value
+    elif name in OPEN_CLASSES:
+        if name in NUMERIC_LITERALS:
+            return f'<{name}>'
+        elif name == 'STRINGLITERAL':
             return '<STRING>'
         else:
-            assert lex.name == 'IDENTIFIER'
+            assert name == 'IDENTIFIER'
             return '<IDENTIFIER>'
-    elif lex.name == 'EOF':
+    elif name == 'EOF':
         return '</s>'
-    elif lex.name == 'ERROR':
+    elif name == 'ERROR':
         return '<ERROR>'
     else:
         # When I forgot to account for a token.
-        raise NotImplementedError(repr(lex))
+        raise NotImplementedError(f'{name} {value!r}')
+
+
+class VindEncoder:
+    """
+    Maps a token's kind and normalized value straight to its Vind, without
+    java2sensibility():
+
+        >>> encode = VindEncoder(vocabulary).encode
+        >>> vocabulary.to_text(encode('LBRACE', '{'))
+        '{'
+        >>> vocabulary.to_text(encode('IDENTIFIER', 'Hello'))
+        '<IDENTIFIER>'
+
+    Closed classes are represented by their value, and open classes by their
+    kind, so each is one lookup in a table built once. Tokens in neither
+    table take the slow path, which counts unknown entries in the
+    vocabulary, rather than warning about each one.
+    """
+    def __init__(self, vocabulary: Vocabulary) -> None:
+        self.vocabulary = vocabulary
+        self.by_value = {}  # type: Dict[str, Vind]
+        self.by_kind = {}  # type: Dict[str, Vind]
+        for value in REPRESENTABLE_CLOSED_CLASSES:
+            if value in vocabulary:
+                self.by_value[value] = vocabulary.to_index(value)
+        for kind in OPEN_CLASSES | NON_REPRESENTABLE_CLOSED_CLASSES:
+            entry = sensibility(kind, '')
+            if entry in vocabulary or kind == 'ERROR':
+                self.by_kind[kind] = vocabulary.to_index(entry)
+
+    def encode(self, name: str, value: str) -> Vind:
+        # Values come first, just as in java2sensibility().
+        vind = self.by_value.get(value)
+        if vind is None:
+            vind = self.by_kind.get(name)
+            if vind is None:
+                return self.vocabulary.to_index(sensibility(name, value))
+        return vind
+
+
+vind_encoder = VindEncoder(vocabulary)
 
 
 def to_str(source: Union[str, bytes, IO[bytes]]) -> str:
@@ -188,3 +348,148 @@ def to_str(source: Union[str, bytes, IO[bytes]]) -> str:
 
 
 java = Java()
+
+
+T = TypeVar('T')
+
+
+class JavaPool:
+    """
+    A pool of worker processes, each with its very own Java server.
+
+    Starting many Java servers at the same time is finicky (see Java.java),
+    so each worker waits `stagger` seconds longer than the previous one
+    before starting its server.
+    """
+    def __init__(self, processes: Optional[int]=None,
+                 stagger: float=1.0) -> None:
+        self.processes = processes or multiprocessing.cpu_count()
+        counter = multiprocessing.Value('i', 0)
+        self._pool = multiprocessing.Pool(self.processes,
+                                          initializer=_start_worker,
+                                          initargs=(counter, stagger))
+
+    def apply(self, func: Callable[..., Any], args: Tuple=()) -> Any:
+        """
+        Calls func(*args) in a worker and waits for the result. Safe to call
+        from several threads at once, to keep all workers busy.
+        """
+        return self._pool.apply(func, args)
+
+    def map_ordered(self, func: Callable[..., Any], items: Iterable[T],
+                    args: Callable[[T], Tuple]=lambda item: (item,),
+                    window: Optional[int]=None) -> Iterator[Tuple[T, Any]]:
+        """
+        Yields (item, func(*args(item))) for each item, in the same order as
+        the input. Unlike Pool.imap(), items are consumed lazily in the
+        calling thread, and at most `window` calls are outstanding at once.
+        """
+        window = window or 2 * self.processes
+        pending = deque()  # type: deque
+        for item in items:
+            pending.append((item, self._pool.apply_async(func, args(item))))
+            if len(pending) >= window:
+                item, result = pending.popleft()
+                yield item, result.get()
+        while pending:
+            item, result = pending.popleft()
+            yield item, result.get()
+
+    def close(self) -> None:
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self) -> 'JavaPool':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if exc_info[0] is None:
+            self.close()
+        else:
+            self._pool.terminate()
+
+
+def _num_parse_errors(source: Union[str, bytes]) -> int:
+    return java.java.get_num_parse_errors(to_str(source))
+
+
+def _num_parse_errors_many(sources: List[Union[str, bytes]]
+                           ) -> List[Union[int, JavaError]]:
+    parse = java.java.get_num_parse_errors
+    results = []  # type: List[Union[int, JavaError]]
+    for source in sources:
+        try:
+            results.append(parse(to_str(source)))
+        except Exception as error:
+            # Sent back from the pool, so keep only the message.
+            results.append(JavaError(f'{type(error).__name__}: {error}'))
+    return results
+
+
+def _tokenize_many(sources: List[Union[str, bytes]]
+                   ) -> List[Union[TokenStream, JavaError]]:
+    lex = java.java.lex
+    results = []  # type: List[Union[TokenStream, JavaError]]
+    for source in sources:
+        try:
+            results.append(java._to_stream(lex(to_str(source))))
+        except Exception as error:
+            results.append(JavaError(f'{type(error).__name__}: {error}'))
+    return results
+
+
+def _start_worker(counter, stagger: float) -> None:
+    with counter.get_lock():
+        position = counter.value
+        counter.value += 1
+    # Forget the parent's Java server, if it had one; and parse right here.
+    java.__dict__.pop('_java_server', None)
+    java.pool = None
+    java.syntax_cache = None
+    time.sleep(position * stagger)
+    java.java
+
+
+def benchmark(number: int=100_000) -> None:
+    """
+    Prints the cost per token of java2sensibility() and Vocabulary.to_index()
+    against the VindEncoder, on a typical mix of tokens.
+    """
+    import timeit
+    mix = [('PUBLIC', 'public'), ('CLASS', 'class'), ('IDENTIFIER', 'Hello'),
+           ('LBRACE', '{'), ('INT', 'int'), ('IDENTIFIER', 'x'), ('EQ', '='),
+           ('INTLITERAL', '1'), ('SEMI', ';'), ('IDENTIFIER', 'System'),
+           ('DOT', '.'), ('IDENTIFIER', 'out'), ('LPAREN', '('),
+           ('STRINGLITERAL', '"hi"'), ('RPAREN', ')'), ('RBRACE', '}')]
+    tokens = (mix * (number // len(mix) + 1))[:number]
+    to_index = vocabulary.to_index
+    encode = vind_encoder.encode
+    by_value = vind_encoder.by_value.get
+    by_kind = vind_encoder.by_kind.get
+
+    def before() -> None:
+        for name, value in tokens:
+            to_index(sensibility(name, value))
+
+    def after() -> None:
+        for name, value in tokens:
+            encode(name, value)
+
+    def inlined() -> None:
+        # As in Java.tokenize().
+        for name, value in tokens:
+            vind = by_value(value)
+            if vind is None:
+                vind = by_kind(name)
+                if vind is None:
+                    vind = encode(name, value)
+
+    for label, func in (('sensibility + to_index', before),
+                        ('VindEncoder.encode', after),
+                        ('inlined', inlined)):
+        seconds = min(timeit.repeat(func, number=1, repeat=5))
+        print(f"{label:>23}: {seconds / number * 1e9:6.0f} ns/token")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -21,11 +21,13 @@ Named `token_utils` because `token` is a Python standard library import, and
 it breaks things if you shadow standard library stuff...
 """
 
-from typing import Iterator
+from array import array
+from typing import Any, Dict, Iterator, List, Sequence, overload
 
 __all__ = [
     'Lexeme',
     'Token',
+    'TokenStream',
     'Location',
     'Position'
 ]
@@ -179,3 +181,91 @@ class Token(Lexeme):
         True if the token spans multiple lines.
         """
         return self.location.spans_single_line
+
+
+class TokenStream(Sequence[Token]):
+    """
+    The tokens of one file, stored as columns rather than as one Token (and
+    two Positions) per token: the kind, vocabulary index, and start and end
+    line/column of every token are packed into arrays. Indexing or iterating
+    creates Token views on demand.
+
+    Kinds are stored as indices into TokenStream.kind_names, which is shared
+    by every stream in a process; use kind_id() to find the index of a kind.
+    Each process numbers kinds as it meets them, so a pickled stream takes
+    its kind names with it.
+    """
+    __slots__ = ('kinds', 'values', 'vinds', 'start_lines', 'start_columns',
+                 'end_lines', 'end_columns')
+
+    kind_names = []  # type: List[str]
+    _kind_ids = {}  # type: Dict[str, int]
+
+    def __init__(self) -> None:
+        self.kinds = array('B')
+        # The (already allocated) value strings, by reference.
+        self.values = []  # type: List[str]
+        self.vinds = array('B')
+        self.start_lines = array('I')
+        self.start_columns = array('I')
+        self.end_lines = array('I')
+        self.end_columns = array('I')
+
+    @classmethod
+    def kind_id(cls, name: str) -> int:
+        """
+        The index of the kind in kind_names, adding it if it's new.
+        """
+        kind = cls._kind_ids.get(name)
+        if kind is None:
+            kind = cls._kind_ids[name] = len(cls.kind_names)
+            cls.kind_names.append(name)
+        return kind
+
+    def append(self, name: str, value: str, vind: int,
+               start: Sequence[int], end: Sequence[int]) -> None:
+        self.kinds.append(self.kind_id(name))
+        self.values.append(value)
+        self.vinds.append(vind)
+        self.start_lines.append(start[0])
+        self.start_columns.append(start[1])
+        self.end_lines.append(end[0])
+        self.end_columns.append(end[1])
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state['kind_names'] = list(self.kind_names)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        names = state.pop('kind_names')
+        for name, value in state.items():
+            setattr(self, name, value)
+        # Renumber the kinds as this process knows them.
+        ids = [self.kind_id(name) for name in names]
+        if ids != list(range(len(ids))):
+            self.kinds = array('B', (ids[kind] for kind in self.kinds))
+
+    def name_of(self, index: int) -> str:
+        return self.kind_names[self.kinds[index]]
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    @overload
+    def __getitem__(self, index: int) -> Token: ...
+    @overload  # noqa: E301
+    def __getitem__(self, index: slice) -> Sequence[Token]: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return Token(name=self.name_of(index), value=self.values[index],
+                     start=Position(line=self.start_lines[index],
+                                    column=self.start_columns[index]),
+                     end=Position(line=self.end_lines[index],
+                                  column=self.end_columns[index]))
+
+    def __iter__(self) -> Iterator[Token]:
+        for index in range(len(self)):
+            yield self[index]
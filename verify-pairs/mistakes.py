@@ -16,7 +16,15 @@
 # limitations under the License.
 
 import sqlite3
-from typing import Iterable, Iterator, NewType, Optional, Tuple
+import threading
+import time
+from collections import OrderedDict
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, NewType, Optional, Tuple, Union
+)
+
+from compression import Codec, DELTA, format_of
+from database import WriteQueue, transaction
 
 # TODO: CONSULT EDIT CLASS IN SENSIBILITY WHEN DOING THIS!
 from vocabulary import Vind
@@ -29,43 +37,137 @@ MEID = NewType('MEID', int)
 Revision = Tuple[SFID, MEID]
 
 # To work along side java-mistakes.sqlite3
-SCHEMA = r"""
-CREATE TABLE IF NOT EXISTS distance(
+#
+# Each migration brings the schema from version N (PRAGMA user_version) to
+# N + 1. Only ever append to this list!
+MIGRATIONS = [
+    r"""
+    CREATE TABLE IF NOT EXISTS distance(
+        source_file_id  INT,
+        before_id       INT,
+        levenshtein     INT,
+        PRIMARY KEY (source_file_id, before_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS edit(
+        source_file_id  INT,
+        before_id       INT,
+
+        -- Line number of the error.
+        line_no         INT NOT NULL,
+
+        -- How to go from the good file to the bad file.
+        edit            TEXT NOT NULL,
+        position        INT NOT NULL,
+        new_token       TEXT,
+
+        -- How to go from the bad file to the good file.
+        fix             TEXT NOT NULL,
+        fix_position    INT NOT NULL,
+        fix_new_token   TEXT,
+
+        PRIMARY KEY (source_file_id, before_id)
+    );
+
+    -- Every edit of the pairs with a few edits; one row per edit.
+    CREATE TABLE IF NOT EXISTS edits(
+        source_file_id  INT,
+        before_id       INT,
+        -- Order of the edit, from the start of the file.
+        n               INT,
+
+        -- How to go from the bad file to the good file.
+        edit            TEXT NOT NULL,
+        -- Token index in the good file, and in the bad file.
+        position        INT NOT NULL,
+        before_position INT NOT NULL,
+        new_token       INT,
+        -- Line number (in the bad file).
+        line_no         INT NOT NULL,
+
+        PRIMARY KEY (source_file_id, before_id, n)
+    );
+    """,
+
+    r"""
+    -- Finding eligible mistakes needs neither a scan nor the table itself.
+    CREATE INDEX IF NOT EXISTS distance_levenshtein
+        ON distance(levenshtein, source_file_id, before_id);
+    """,
+]
+
+# Optional: eligible mistakes, maintained by triggers as distances and
+# edits are inserted. See Mistakes.materialize_eligible().
+ELIGIBLE_SCHEMA = r"""
+CREATE TABLE IF NOT EXISTS eligible(
     source_file_id  INT,
     before_id       INT,
-    levenshtein     INT,
+    -- Whether the edit table has a row for this mistake yet.
+    edited          INT NOT NULL DEFAULT 0,
     PRIMARY KEY (source_file_id, before_id)
-);
+) WITHOUT ROWID;
 
-CREATE TABLE IF NOT EXISTS edit(
-    source_file_id  INT,
-    before_id       INT,
+CREATE TRIGGER IF NOT EXISTS eligible_on_distance
+AFTER INSERT ON distance WHEN NEW.levenshtein = 1
+BEGIN
+    INSERT OR IGNORE INTO eligible(source_file_id, before_id)
+    VALUES (NEW.source_file_id, NEW.before_id);
+END;
 
-    -- Line number of the error.
-    line_no         INT NOT NULL,
+CREATE TRIGGER IF NOT EXISTS eligible_on_edit
+AFTER INSERT ON edit
+BEGIN
+    UPDATE eligible SET edited = 1
+     WHERE source_file_id = NEW.source_file_id
+       AND before_id = NEW.before_id;
+END;
 
-    -- How to go from the good file to the bad file.
-    edit            TEXT NOT NULL,
-    position        INT NOT NULL,
-    new_token       TEXT,
+INSERT OR IGNORE INTO eligible(source_file_id, before_id, edited)
+    SELECT source_file_id, before_id,
+           EXISTS (SELECT 1 FROM edit
+                    WHERE edit.source_file_id = distance.source_file_id
+                      AND edit.before_id = distance.before_id)
+      FROM distance
+     WHERE levenshtein = 1;
+"""
 
-    -- How to go from the bad file to the good file.
-    fix             TEXT NOT NULL,
-    position        TEXT NOT NULL,
-    new_tok         TEXT,
 
-    PRIMARY KEY (source_file_id, before_id)
-);
-"""
+def migrate(conn: sqlite3.Connection) -> int:
+    """
+    Applies every migration the database hasn't had yet, each in its own
+    transaction. Returns the new schema version.
+    """
+    version, = conn.execute('PRAGMA user_version').fetchone()
+    for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        # executescript() can't be part of a transaction, so spell it out.
+        try:
+            conn.executescript(f"""
+                BEGIN;
+                {script}
+                PRAGMA user_version = {number};
+                COMMIT;
+            """)
+        except sqlite3.Error:
+            # Don't leave the caller inside a half-applied migration.
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+    return max(version, len(MIGRATIONS))
 
 
 class EditType:
     """
     Symbolic constants for Insertion, Deletion, and Substitution.
     """
+    id: str
+
     def __repr__(self) -> str:
         return type(self).__name__
 
+    def __reduce__(self) -> str:
+        # Pickle as a reference to the module-level constant.
+        return type(self).__name__
+
 
 Insertion = type('Insertion', (EditType,), {'id': 'i'})()
 Deletion = type('Deletion', (EditType,), {'id': 'x'})()
@@ -89,53 +191,473 @@ class Edit:
 class Mistake:
     """
     Represents a mistake in the database.
+
+    Mistakes read from a Mistakes database are handles: their before and
+    after sources are only loaded when first accessed.
     """
     def __init__(self, sfid: SFID, meid: MEID,
-                 before: bytes, after: bytes) -> None:
+                 before: Optional[bytes], after: Optional[bytes],
+                 after_id: MEID, *, rowid: Optional[int]=None,
+                 database: Optional['Mistakes']=None) -> None:
         self.sfid = sfid
         self.meid = meid
-        self.before = before
-        self.after = after
+        self._before = before
+        self._after = after
+        self.after_id = after_id
+        self.rowid = rowid
+        self._database = database
+
+    @property
+    def before(self) -> bytes:
+        if self._before is None:
+            self._before = self._load('before')
+        return self._before
+
+    @before.setter
+    def before(self, source: bytes) -> None:
+        self._before = source
+
+    @property
+    def after(self) -> bytes:
+        if self._after is None:
+            self._after = self._load('after')
+        return self._after
+
+    @after.setter
+    def after(self, source: bytes) -> None:
+        self._after = source
+
+    def _load(self, column: str) -> bytes:
+        assert self._database is not None and self.rowid is not None, (
+            'Mistake was not read from a database'
+        )
+        # After may be stored as a delta against before.
+        return self._database.load_source(self.rowid, column,
+                                          base=lambda: self.before)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The database connection stays in this process.
+        state = dict(self.__dict__)
+        state['_database'] = None
+        return state
+
+    @property
+    def before_revision(self) -> Revision:
+        return (self.sfid, self.meid)
+
+    @property
+    def after_revision(self) -> Revision:
+        return (self.sfid, self.after_id)
 
     def __repr__(self) -> str:
         return '<mistake sfid=%d, mfid=%d>' % (self.sfid, self.meid)
 
 
+ELIGIBLE_QUERY = '''
+    SELECT mistake.rowid, source_file_id, before_id, after_id
+    FROM mistake NATURAL JOIN distance
+    WHERE levenshtein = 1
+'''
+
+
 class Mistakes(Iterable[Mistake]):
     """
     Access to the mistake database.
     """
-    def __init__(self, conn: sqlite3.Connection) -> None:
+    def __init__(self, conn: sqlite3.Connection, *,
+                 batch_size: int=1,
+                 writer: Optional[WriteQueue]=None) -> None:
         self.conn = conn
-        self.conn.executescript(SCHEMA)
+        migrate(conn)
+        # Sources may be stored compressed (see compression.py).
+        self.codec = Codec(conn)
+        # Distances and edits are written together, batch_size rows at a
+        # time, in one transaction (through the writer, if given). Use as a
+        # context manager to write the last batch.
+        self.batch_size = batch_size
+        self.writer = writer
+        self.pending = OrderedDict()  # type: Dict[str, List[Tuple[Any, ...]]]
+        self.num_pending = 0
+
+    # Rows fetched from SQLite at a time when iterating.
+    chunk_size = 1000
 
     def __iter__(self) -> Iterator[Mistake]:
-        query = 'SELECT source_file_id, before_id, before, after FROM mistake'
-        for row in self.conn.execute(query):
-            yield Mistake(*row)
+        return self._handles('''
+            SELECT rowid, source_file_id, before_id, after_id
+            FROM mistake
+            ''')
 
     @property
     def eligible_mistakes(self) -> Iterator[Mistake]:
-        query = '''
-            SELECT source_file_id, before_id, before, after
-            FROM mistake NATURAL JOIN distance
-            WHERE levenshtein = 1
-            '''
-        for row in self.conn.execute(query):
-            yield Mistake(*row)
-
-    def insert_distance(self, m: Mistake, dist: int) -> None:
-        with self.conn:
-            self.conn.execute('''
-                INSERT INTO distance(source_file_id, before_id, levenshtein)
-                VALUES (?, ?, ?)
-            ''', (m.sfid, m.meid, dist))
-
-    def insert_edit(self, m: Mistake, edit: Edit) -> None:
-        with self.conn:
-            self.conn.execute('''
-                INSERT INTO edit(
-                    source_file_id, before_id, edit, position, new_token
+        if self.eligible_is_materialized:
+            return self._handles('''
+                SELECT mistake.rowid, source_file_id, before_id, after_id
+                FROM eligible NATURAL JOIN mistake
+                ''')
+        return self._handles(ELIGIBLE_QUERY)
+
+    @property
+    def eligible_is_materialized(self) -> bool:
+        return self.conn.execute('''
+            SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'eligible'
+        ''').fetchone() is not None
+
+    def materialize_eligible(self) -> None:
+        """
+        Creates (and fills) the eligible table. From then on, inserting into
+        the distance and edit tables keeps it up to date.
+        """
+        self.flush()
+        self.conn.executescript(f"BEGIN; {ELIGIBLE_SCHEMA} COMMIT;")
+
+    def _handles(self, query: str, params: Tuple=()) -> Iterator[Mistake]:
+        """
+        Streams the results of a query for (rowid, sfid, meid, after_id) as
+        Mistakes whose sources are loaded on demand, so memory use doesn't
+        grow with the size of the database.
+        """
+        cursor = self.conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(self.chunk_size)
+            if not rows:
+                break
+            for rowid, sfid, meid, after_id in rows:
+                yield Mistake(sfid, meid, None, None, after_id,
+                              rowid=rowid, database=self)
+
+    def load_source(self, rowid: int, column: str,
+                    base: Optional[Callable[[], bytes]]=None) -> bytes:
+        """
+        Reads the before or after source of a mistake, by rowid. If it's
+        stored as a delta, base() is called for the source it's against.
+        """
+        assert column in ('before', 'after')
+        # Incremental blob I/O skips the SQL layer entirely (Python 3.11+).
+        if hasattr(self.conn, 'blobopen'):
+            with self.conn.blobopen('mistake', column, rowid) as handle:
+                blob = handle.read()
+        else:
+            blob, = self.conn.execute(
+                f'SELECT {column} FROM mistake WHERE rowid = ?', (rowid,)
+            ).fetchone()
+        if format_of(blob) == DELTA:
+            assert base is not None
+            return self.codec.decode(blob, base())
+        return self.codec.decode(blob)
+
+    def rowid_ranges(self, size: int) -> Iterator[Tuple[int, int]]:
+        """
+        Splits the mistake table into inclusive ranges of at most size rowids.
+        """
+        first, last = self.conn.execute(
+            'SELECT MIN(rowid), MAX(rowid) FROM mistake'
+        ).fetchone()
+        if first is None:
+            return
+        for start in range(first, last + 1, size):
+            yield start, min(start + size - 1, last)
+
+    def without_distance(self, rowids: Tuple[int, int]) -> Iterator[Mistake]:
+        """
+        Mistakes in the (inclusive) range of rowids whose distance hasn't
+        been stored yet.
+        """
+        return self._handles('''
+            SELECT rowid, source_file_id, before_id, after_id
+            FROM mistake
+            WHERE rowid BETWEEN ? AND ?
+              AND NOT EXISTS (
+                SELECT 1 FROM distance
+                 WHERE distance.source_file_id = mistake.source_file_id
+                   AND distance.before_id = mistake.before_id
+              )
+            ''', rowids)
+
+    def insert_distance(self, m: Mistake, dist: Union[int, str]) -> None:
+        """
+        Stores the distance of a mistake; or '>k', if it's known to be
+        more than k.
+        """
+        self._add('''
+            INSERT INTO distance(source_file_id, before_id, levenshtein)
+            VALUES (?, ?, ?)
+        ''', (m.sfid, m.meid, dist))
+
+    def insert_edit(self, m: Mistake, edit: Edit, fix: Optional[Edit]=None,
+                    line_no: int=0) -> None:
+        fix = fix or edit
+        self._add('''
+            INSERT INTO edit(
+                source_file_id, before_id, line_no,
+                edit, position, new_token,
+                fix, fix_position, fix_new_token
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (m.sfid, m.meid, line_no,
+              edit.type.id, edit.position, edit.new_token,
+              fix.type.id, fix.position, fix.new_token))
+
+    def insert_fix_events(self, m: Mistake, events: Iterable[Any]) -> None:
+        """
+        Stores every edit (distance.FixEvent) of a mistake in the edits table.
+        """
+        for n, event in enumerate(events):
+            fix = event.fix
+            self._add('''
+                INSERT INTO edits(
+                    source_file_id, before_id, n, edit, position,
+                    before_position, new_token, line_no
                 )
-                VALUES (?, ?, ?, ?, ?)
-            ''', (m.sfid, m.meid, edit.type.id, edit.position, edit.new_token))
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (m.sfid, m.meid, n, fix.type.id, fix.position,
+                  event.source_position, fix.new_token, event.line_no))
+
+    def _add(self, sql: str, row: Tuple[Any, ...]) -> None:
+        self.pending.setdefault(sql, []).append(row)
+        self.num_pending += 1
+        if self.num_pending >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write all pending rows, to every table, in one transaction.
+        """
+        if not self.pending:
+            return
+        with transaction(self.conn, self.writer) as tx:
+            for sql, rows in self.pending.items():
+                tx.executemany(sql, rows)
+        self.pending.clear()
+        self.num_pending = 0
+
+    def __enter__(self) -> 'Mistakes':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+
+
+class BatchWriter:
+    """
+    Buffers rows to insert, and inserts them with one transaction per batch,
+    rather than one transaction (and one fsync) per row. A batch is written
+    once it has batch_size rows, or once its oldest row is interval seconds
+    old.
+
+    Checking the age of the batch in add() alone would leave rows unwritten
+    for as long as no more come. So if it can write from another thread --
+    through a WriteQueue, or through a connection shared between threads
+    (check_same_thread=False) and guarded by lock -- a thread also flushes
+    the batch when the interval is up.
+
+    Use as a context manager, or call close(), to make sure the last batch
+    is written, even if the program is interrupted.
+    """
+    def __init__(self, conn: sqlite3.Connection, sql: str, *,
+                 batch_size: int=1000, interval: float=5.0,
+                 writer: Optional[WriteQueue]=None,
+                 lock: Optional[threading.RLock]=None) -> None:
+        self.conn = conn
+        self.writer = writer
+        self.sql = sql
+        self.batch_size = batch_size
+        self.interval = interval
+        self.rows = []  # type: List[Tuple[Any, ...]]
+        self.last_flush = time.monotonic()
+        self._lock = lock or threading.RLock()
+        self._closed = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+        if writer is not None or lock is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='batch writer')
+            self._thread.start()
+
+    def add(self, row: Tuple[Any, ...]) -> None:
+        with self._lock:
+            self.rows.append(row)
+            if (len(self.rows) >= self.batch_size or
+                    time.monotonic() - self.last_flush >= self.interval):
+                self.flush()
+
+    def flush(self) -> None:
+        """
+        Write all buffered rows in one transaction.
+        """
+        with self._lock:
+            if self.rows:
+                with transaction(self.conn, self.writer) as tx:
+                    tx.executemany(self.sql, self.rows)
+                self.rows = []
+            self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        """
+        Stops the flushing thread, and writes the last batch.
+        """
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _run(self) -> None:
+        timeout = self.interval
+        while not self._closed.wait(timeout):
+            with self._lock:
+                waited = time.monotonic() - self.last_flush
+                if waited >= self.interval:
+                    try:
+                        self.flush()
+                    except Exception:
+                        # The rows are still buffered; the next add() or
+                        # flush() will fail the same way, where the caller
+                        # can see it.
+                        return
+                    waited = 0
+            timeout = self.interval - waited
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __enter__(self) -> 'BatchWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def test_batch_writer() -> None:
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE t(x INT)')
+    with BatchWriter(conn, 'INSERT INTO t VALUES (?)',
+                     batch_size=3, interval=3600) as writer:
+        for x in range(5):
+            writer.add((x,))
+        # Only the first batch has been written so far.
+        assert conn.execute('SELECT COUNT(*) FROM t').fetchone() == (3,)
+        assert len(writer) == 2
+    assert conn.execute('SELECT COUNT(*) FROM t').fetchone() == (5,)
+
+
+def test_batch_writer_interval() -> None:
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.execute('CREATE TABLE t(x INT)')
+    lock = threading.RLock()
+    with BatchWriter(conn, 'INSERT INTO t VALUES (?)', batch_size=1000,
+                     interval=0.05, lock=lock) as writer:
+        writer.add((1,))
+        # No more rows come, but the batch is written anyway.
+        deadline = time.monotonic() + 5
+        while len(writer) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with lock:
+            assert conn.execute('SELECT COUNT(*) FROM t').fetchone() == (1,)
+    assert writer._thread is not None and not writer._thread.is_alive()
+
+
+def _test_database() -> Mistakes:
+    conn = sqlite3.connect(':memory:')
+    # Normally created by verify-pairs.py.
+    conn.execute('''
+        CREATE TABLE mistake (
+            source_file_id  INT,
+            before_id       INT,
+            after_id        INT,
+            before          BLOB,
+            after           BLOB,
+            PRIMARY KEY (source_file_id, before_id)
+        )
+    ''')
+    conn.executemany('''
+        INSERT INTO mistake VALUES (?, ?, ?, ?, ?)
+    ''', [(1, meid, meid + 1, b'class A {', b'class A { }')
+          for meid in range(1, 20, 2)])
+    conn.commit()
+    return Mistakes(conn)
+
+
+def test_migrations() -> None:
+    mistakes = _test_database()
+    assert migrate(mistakes.conn) == len(MIGRATIONS)
+    version, = mistakes.conn.execute('PRAGMA user_version').fetchone()
+    assert version == len(MIGRATIONS)
+    # Migrating again does nothing.
+    Mistakes(mistakes.conn)
+    assert migrate(mistakes.conn) == len(MIGRATIONS)
+
+    # A failed migration is rolled back entirely.
+    MIGRATIONS.append('''
+        CREATE TABLE half_done(x);
+        INSERT INTO no_such_table VALUES (1);
+    ''')
+    try:
+        migrate(mistakes.conn)
+    except sqlite3.OperationalError:
+        pass
+    else:
+        assert False, 'Expected the migration to fail'
+    finally:
+        MIGRATIONS.pop()
+    assert not mistakes.conn.in_transaction
+    assert mistakes.conn.execute('''
+        SELECT COUNT(*) FROM sqlite_master WHERE name = 'half_done'
+    ''').fetchone() == (0,)
+    version, = mistakes.conn.execute('PRAGMA user_version').fetchone()
+    assert version == len(MIGRATIONS)
+
+
+def test_lazy_mistakes() -> None:
+    mistakes = _test_database()
+    mistakes.chunk_size = 3
+    handles = list(mistakes)
+    assert [m.meid for m in handles] == list(range(1, 20, 2))
+    assert handles[0]._before is None
+    assert handles[0].before == b'class A {'
+    assert handles[-1].after == b'class A { }'
+    assert handles[-1].after_revision == (1, 20)
+
+    # After may be stored as a delta against before.
+    delta = mistakes.codec.encode_delta(b'class A { } // fixed', b'class A {')
+    mistakes.conn.execute('''
+        UPDATE mistake SET after = ? WHERE rowid = ?
+    ''', (delta, handles[1].rowid))
+    assert list(mistakes)[1].after == b'class A { } // fixed'
+
+
+def test_eligible_query_plan() -> None:
+    mistakes = _test_database()
+    plan = [detail for *_, detail in mistakes.conn.execute(
+        'EXPLAIN QUERY PLAN ' + ELIGIBLE_QUERY
+    )]
+    # Look up distances of 1 in the index, and each mistake by its key.
+    assert any('distance' in step and
+               'COVERING INDEX distance_levenshtein' in step for step in plan)
+    assert all(step.startswith('SEARCH') for step in plan)
+
+
+def test_materialized_eligible() -> None:
+    mistakes = _test_database()
+    first, second, *rest = mistakes
+    mistakes.insert_distance(first, 1)
+    mistakes.insert_distance(second, 3)
+    mistakes.materialize_eligible()
+    assert mistakes.eligible_is_materialized
+    for m in rest:
+        mistakes.insert_distance(m, 1)
+    mistakes.insert_edit(first, Edit(Insertion, 3, Vind(41)))
+
+    assert ([m.meid for m in mistakes.eligible_mistakes] ==
+            [first.meid] + [m.meid for m in rest])
+    assert mistakes.conn.execute('''
+        SELECT before_id FROM eligible WHERE edited
+    ''').fetchall() == [(first.meid,)]
+
+    # Every mistake is looked up by its key, never scanned.
+    plan = [detail for *_, detail in mistakes.conn.execute('''
+        EXPLAIN QUERY PLAN
+        SELECT mistake.rowid FROM eligible NATURAL JOIN mistake
+    ''')]
+    assert any(step.startswith('SEARCH') and 'mistake' in step
+               for step in plan)
+    assert not any(step.startswith('SCAN') and 'mistake' in step
+                   for step in plan)
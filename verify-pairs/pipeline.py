@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright 2017 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A streaming pipeline of stages connected by bounded queues.
+
+Each stage has one or more worker threads that take items from the stage's
+queue, process them, and put them on the next stage's queue. Since the
+queues are bounded, a slow stage makes the earlier stages wait for it
+(backpressure), rather than letting items pile up in memory.
+"""
+
+import logging
+import threading
+import time
+from queue import Empty, Queue
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+from timing import Timings
+
+
+# Put on a queue once per worker to tell it to stop.
+_DONE = object()
+
+
+class Stage:
+    """
+    A step of the pipeline. func is called on every item, in one of
+    `workers` threads; it should update the item in place.
+
+    Given a batch_size, func is instead called on a list of up to
+    batch_size items: whatever is waiting, without waiting for more.
+    """
+    def __init__(self, name: str, func: Callable[[Any], None],
+                 workers: int=1, batch_size: Optional[int]=None) -> None:
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.processed = 0
+        # Replaced by a bounded queue by the pipeline.
+        self.inbox = Queue()  # type: Queue
+        self._lock = threading.Lock()
+        self._running = 0
+
+
+class Pipeline:
+    """
+    Runs items through stages, in their own threads, with at most maxsize
+    items waiting in front of each stage.
+
+    Items must not be dropped by any stage, because the output of the
+    pipeline is used to know when everything's done; instead, stages should
+    mark items as rejected and later stages should pass over them. If a
+    stage raises anyway, on_error(item, stage_name) is called on each of
+    its items before passing them along, so they can be marked.
+    """
+    def __init__(self, stages: List[Stage], *, maxsize: int=64,
+                 timings: Optional[Timings]=None,
+                 on_error: Optional[Callable[[Any, str], None]]=None
+                 ) -> None:
+        self.stages = stages
+        self.maxsize = maxsize
+        self.timings = timings or Timings()
+        self.on_error = on_error
+        self._error = None  # type: Optional[BaseException]
+        self.logger = logging.getLogger(type(self).__name__)
+        self.outbox = Queue(maxsize)  # type: Queue
+        for stage in stages:
+            stage.inbox = Queue(maxsize)
+        self.started = time.perf_counter()
+
+    def run(self, items: Iterable[Any]) -> Iterator[Any]:
+        """
+        Feeds items to the first stage (in a thread of its own) and yields
+        them as they come out of the last stage. Items with more than one
+        worker in any stage may come out in a different order.
+
+        If reading the items fails, the items read so far are finished,
+        then the error is raised.
+        """
+        self.started = time.perf_counter()
+        self._error = None
+        threads = [threading.Thread(target=self._read, args=(items,),
+                                    name='reader', daemon=True)]
+        for i, stage in enumerate(self.stages):
+            outbox = (self.stages[i + 1].inbox if i + 1 < len(self.stages)
+                      else self.outbox)
+            stage._running = stage.workers
+            for n in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work, args=(stage, outbox),
+                    name='%s-%d' % (stage.name, n), daemon=True
+                ))
+        for thread in threads:
+            thread.start()
+
+        while True:
+            item = self.outbox.get()
+            if item is _DONE:
+                break
+            yield item
+        if self._error is not None:
+            raise self._error
+
+    def status(self) -> str:
+        """
+        Throughput of each stage, and how many items are waiting for it.
+        """
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return ' '.join(
+            '%s=%.1f/s[%d]' % (stage.name, stage.processed / elapsed,
+                               stage.inbox.qsize())
+            for stage in self.stages
+        )
+
+    def _read(self, items: Iterable[Any]) -> None:
+        first = self.stages[0]
+        try:
+            for item in items:
+                first.inbox.put(item)
+        except Exception as error:
+            # Raised by run(), once the stages are done.
+            self._error = error
+        finally:
+            for _ in range(first.workers):
+                first.inbox.put(_DONE)
+
+    def _work(self, stage: Stage, outbox: Queue) -> None:
+        done = False
+        while not done:
+            item = stage.inbox.get()
+            if item is _DONE:
+                break
+            batch = [item]
+            while len(batch) < (stage.batch_size or 1):
+                try:
+                    item = stage.inbox.get_nowait()
+                except Empty:
+                    break
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+            try:
+                with self.timings.time(stage.name):
+                    if stage.batch_size is not None:
+                        stage.func(batch)
+                    else:
+                        stage.func(batch[0])
+            except Exception:
+                # The stage should have handled this itself; pass the items
+                # along rather than losing track of them.
+                self.logger.exception('Error in %s: %r', stage.name, batch)
+                if self.on_error is not None:
+                    for item in batch:
+                        self.on_error(item, stage.name)
+            with stage._lock:
+                stage.processed += len(batch)
+            for item in batch:
+                outbox.put(item)
+
+        # The last worker out tells the next stage to stop.
+        with stage._lock:
+            stage._running -= 1
+            last = stage._running == 0
+        if last:
+            if outbox is self.outbox:
+                outbox.put(_DONE)
+            else:
+                next_stage = self.stages[self.stages.index(stage) + 1]
+                for _ in range(next_stage.workers):
+                    outbox.put(_DONE)
+
+
+def test_pipeline() -> None:
+    class Item:
+        def __init__(self, n: int) -> None:
+            self.n = n
+            self.path = []  # type: List[str]
+
+    def double(item: Item) -> None:
+        item.n *= 2
+        item.path.append('double')
+
+    def increment(item: Item) -> None:
+        item.n += 1
+        item.path.append('increment')
+
+    def explode(item: Item) -> None:
+        if item.n == 7:
+            raise ValueError(item.n)
+
+    pipeline = Pipeline([Stage('double', double, workers=3),
+                         Stage('increment', increment),
+                         Stage('explode', explode, workers=2)],
+                        maxsize=2)
+    results = list(pipeline.run(Item(n) for n in range(100)))
+    assert sorted(item.n for item in results) == [2 * n + 1 for n in range(100)]
+    assert all(item.path == ['double', 'increment'] for item in results)
+    assert all(stage.processed == 100 for stage in pipeline.stages)
+    assert 'double=' in pipeline.status()
+
+
+def test_errors() -> None:
+    failed = []  # type: List[int]
+
+    def explode(n: int) -> None:
+        if n % 10 == 7:
+            raise ValueError(n)
+
+    def read() -> Iterator[int]:
+        yield from range(50)
+        raise IOError('input truncated')
+
+    pipeline = Pipeline([Stage('explode', explode, workers=2)],
+                        on_error=lambda n, stage: failed.append(n))
+    results = []  # type: List[int]
+    try:
+        for n in pipeline.run(read()):
+            results.append(n)
+    except IOError:
+        pass
+    else:
+        assert False, 'Expected the error reading the input'
+    assert sorted(results) == list(range(50))
+    assert sorted(failed) == [7, 17, 27, 37, 47]
+
+
+def test_batches() -> None:
+    sizes = []  # type: List[int]
+
+    def total(items: List[List[int]]) -> None:
+        sizes.append(len(items))
+        for item in items:
+            item.append(sum(item))
+
+    pipeline = Pipeline([Stage('total', total, workers=2, batch_size=4)],
+                        maxsize=8)
+    results = list(pipeline.run([n, n] for n in range(100)))
+    assert sorted(item[2] for item in results) == [2 * n for n in range(100)]
+    assert max(sizes) <= 4 and sum(sizes) == 100
+    assert pipeline.stages[0].processed == 100
@@ -0,0 +1 @@
+../utils/rangeset.py
\ No newline at end of file
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright 2017 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reorders work so that sources stored on the same date are fetched together.
+
+The sources of each date live in their own index and payload files. Pairs
+arrive in session order, so consecutive pairs tend to hop between dates,
+which makes the compile server (or DiskSource) load and evict indices over
+and over again. Within a window of pairs, we can instead process all pairs of
+one date together.
+"""
+
+import heapq
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, TypeVar
+
+from mistakes import MEID
+
+
+T = TypeVar('T')
+Numbered = Tuple[int, T]
+
+
+def by_date(items: Iterable[Numbered],
+            meid_of: Callable[[Numbered], MEID],
+            dates_of: Callable[[List[MEID]], Dict[MEID, str]],
+            window: int) -> Iterator[Numbered]:
+    """
+    Takes items numbered consecutively from zero (e.g., from enumerate()),
+    and reorders every chunk of `window` items by the date of their master
+    event. Items with the same date (or an unknown date) keep their relative
+    order; unknown dates go last.
+
+    >>> dates = {10: '2014-01-02', 11: '2014-01-01', 12: '2014-01-02'}
+    >>> items = enumerate([10, 11, 12, 13, 11])
+    >>> list(by_date(items, lambda item: item[1],
+    ...              lambda meids: {m: dates[m] for m in meids if m in dates},
+    ...              window=4))
+    [(1, 11), (0, 10), (2, 12), (3, 13), (4, 11)]
+    """
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, window))
+        if not chunk:
+            break
+        dates = dates_of([meid_of(item) for item in chunk])
+        # '~' sorts after any ISO 8601 date.
+        chunk.sort(key=lambda item: dates.get(meid_of(item), '~'))
+        yield from chunk
+
+
+def restore_order(items: Iterable[T],
+                  number_of: Callable[[T], int]) -> Iterator[T]:
+    """
+    Yields items in order of their number, as soon as all items before them
+    have been seen. Numbers must be consecutive and start at zero, so
+    nothing may be dropped before this point.
+
+    >>> list(restore_order([(1, 'b'), (0, 'a'), (3, 'd'), (2, 'c')],
+    ...                    number_of=lambda item: item[0]))
+    [(0, 'a'), (1, 'b'), (2, 'c'), (3, 'd')]
+    """
+    waiting = []  # type: List[Tuple[int, int, T]]
+    expected = 0
+    # The tie-breaker keeps heapq from ever comparing the items themselves.
+    for tie_breaker, item in enumerate(items):
+        heapq.heappush(waiting, (number_of(item), tie_breaker, item))
+        while waiting and waiting[0][0] == expected:
+            yield heapq.heappop(waiting)[2]
+            expected += 1
+    assert not waiting, 'Numbers were missing before %d' % (expected,)
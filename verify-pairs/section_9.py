@@ -0,0 +1 @@
+../utils/section_9.py
\ No newline at end of file
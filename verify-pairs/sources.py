@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright 2017 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Fetches source code at a particular revision.
+"""
+
+import mmap
+import os
+import struct
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from mistakes import MEID, Revision, SFID
+from section_9 import DateCache, index_fmt
+
+
+# Where compile-server.py listens.
+DEFAULT_URL = 'http://localhost:8080/'
+
+
+class SourceNotFound(Exception):
+    """
+    Raised when the source code at a revision cannot be found.
+    """
+
+
+class HTTPSource:
+    """
+    Gets source code from compile-server.py, reusing keep-alive connections.
+    Transient errors (connection failures, 502, 503, 504) are retried with
+    exponential backoff; any other error status raises SourceNotFound.
+    """
+    def __init__(self, url: str=DEFAULT_URL, *,
+                 pool_size: int=8, retries: int=3, backoff: float=0.5,
+                 timeout: float=60.0) -> None:
+        self.url = url
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=(502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __call__(self, revision: Revision) -> bytes:
+        sfid, meid = revision
+        r = self.session.get(self.url, params=dict(sfid=sfid, meid=meid),
+                             timeout=self.timeout)
+        try:
+            r.raise_for_status()
+        except requests.exceptions.HTTPError as error:
+            raise SourceNotFound(revision) from error
+        return r.content
+
+
+class DiskSource:
+    """
+    Reads source code straight out of the index- and payload- files in
+    directory (e.g., /data/compile-inputs), without going through
+    compile-server.py.
+
+    The date of each master event must already be in the date cache (see
+    utils/dates-of.py). The most recently used indices and payload files are
+    kept loaded (and memory-mapped, respectively).
+    """
+    def __init__(self, directory: str, date_cache: DateCache, *,
+                 max_dates: int=32) -> None:
+        self.directory = directory
+        self.date_cache = date_cache
+        self.max_dates = max_dates
+        self._indices = OrderedDict()  # type: OrderedDict
+        self._payloads = OrderedDict()  # type: OrderedDict
+        self._lock = Lock()
+
+    def __call__(self, revision: Revision) -> bytes:
+        sfid, meid = revision
+        try:
+            date = self.date_cache[meid]
+        except KeyError:
+            raise SourceNotFound(revision)
+
+        with self._lock:
+            try:
+                start, length = self._index(date)[sfid, meid]
+                payload = self._payload(date)
+            except (KeyError, OSError, ValueError, struct.error) as error:
+                # Not indexed, or a missing, truncated, or corrupt file.
+                raise SourceNotFound(revision) from error
+            if start + length > len(payload):
+                raise SourceNotFound(revision)
+            return payload[start:start + length]
+
+    def _index(self, date: str) -> Dict[Revision, Tuple[int, int]]:
+        if date in self._indices:
+            self._indices.move_to_end(date)
+            return self._indices[date]
+
+        path = os.path.join(self.directory, 'index-' + date)
+        index = {}  # type: Dict[Revision, Tuple[int, int]]
+        # Empty files can't be memory-mapped.
+        if os.path.getsize(path) > 0:
+            with open(path, 'rb') as index_file, \
+                    mmap.mmap(index_file.fileno(), 0,
+                              access=mmap.ACCESS_READ) as contents:
+                index = {(sfid, meid): (start, length)
+                         for sfid, meid, start, length, _success
+                         in index_fmt.iter_unpack(contents)}
+        self._indices[date] = index
+        if len(self._indices) > self.max_dates:
+            self._indices.popitem(last=False)
+        return index
+
+    def _payload(self, date: str) -> Union[mmap.mmap, bytes]:
+        if date in self._payloads:
+            self._payloads.move_to_end(date)
+            return self._payloads[date]
+
+        path = os.path.join(self.directory, 'payload-' + date)
+        payload = b''  # type: Union[mmap.mmap, bytes]
+        # Empty files can't be memory-mapped.
+        if os.path.getsize(path) > 0:
+            with open(path, 'rb') as payload_file:
+                payload = mmap.mmap(payload_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        self._payloads[date] = payload
+        if len(self._payloads) > self.max_dates:
+            _date, oldest = self._payloads.popitem(last=False)
+            if isinstance(oldest, mmap.mmap):
+                oldest.close()
+        return payload
+
+
+def test_disk_source(tmpdir) -> None:
+    date = '2013-06-12'
+    sources = [b'class A {', b'class B { }', b'']
+    with open(os.path.join(str(tmpdir), 'payload-' + date), 'wb') as payload, \
+            open(os.path.join(str(tmpdir), 'index-' + date), 'wb') as index:
+        for meid, source in enumerate(sources, start=100):
+            index.write(index_fmt.pack(7, meid, payload.tell(), len(source), 0))
+            payload.write(source)
+
+    date_cache = DateCache(os.path.join(str(tmpdir), 'dates.sqlite3'))
+    date_cache.update((meid, date) for meid in (100, 101, 102, 103))
+    fetch = DiskSource(str(tmpdir), date_cache)
+    for meid, source in enumerate(sources, start=100):
+        assert fetch((SFID(7), MEID(meid))) == source
+
+    def write(name: str, contents: bytes) -> None:
+        with open(os.path.join(str(tmpdir), name), 'wb') as file:
+            file.write(contents)
+    # Empty index; empty payload; no payload; truncated index.
+    write('index-2013-06-13', b'')
+    write('payload-2013-06-13', b'')
+    write('index-2013-06-14', index_fmt.pack(7, 201, 0, 4, 0))
+    write('payload-2013-06-14', b'')
+    write('index-2013-06-15', index_fmt.pack(7, 202, 0, 4, 0))
+    write('index-2013-06-16', index_fmt.pack(7, 203, 0, 4, 0)[:-1])
+    write('payload-2013-06-16', b'ABCD')
+    date_cache.update([(200, '2013-06-13'), (201, '2013-06-14'),
+                       (202, '2013-06-15'), (203, '2013-06-16')])
+
+    for sfid, meid in [(7, 103), (8, 100), (7, 999),
+                       (7, 200), (7, 201), (7, 202), (7, 203)]:
+        missing = SFID(sfid), MEID(meid)
+        try:
+            fetch(missing)
+        except SourceNotFound:
+            pass
+        else:
+            assert False, 'Expected SourceNotFound for %r' % (missing,)
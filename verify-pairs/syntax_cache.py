@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright 2017 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Remembers the number of syntax errors in every source file ever parsed.
+
+The same source snapshot is parsed many times: the after of one pair is
+often the before or after of another, and students often recompile without
+changing anything. Source files are keyed by a hash of their contents, so it
+doesn't matter where they came from.
+"""
+
+import hashlib
+import logging
+from threading import Lock
+from typing import Optional, Union
+
+from database import connect
+
+SCHEMA = r"""
+CREATE TABLE IF NOT EXISTS syntax(
+    hash            BLOB PRIMARY KEY,
+    parse_errors    INT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def content_hash(source: Union[str, bytes]) -> bytes:
+    """
+    A 128-bit hash of the source code (as UTF-8 bytes).
+    """
+    if isinstance(source, str):
+        source = source.encode('UTF-8')
+    return hashlib.blake2b(source, digest_size=16).digest()
+
+
+class SyntaxCache:
+    """
+    Persistent map of source code -> number of parse errors, stored in a
+    SQLite database. Safe to share between threads.
+    """
+    def __init__(self, path: str) -> None:
+        # Losing the last few entries on a crash is harmless, so don't wait
+        # for an fsync on every insert.
+        self.conn = connect(path, synchronous='NORMAL',
+                            check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def get(self, source: Union[str, bytes]) -> Optional[int]:
+        """
+        Returns the number of parse errors, or None if this source was never
+        parsed.
+        """
+        key = content_hash(source)
+        with self._lock:
+            row = self.conn.execute('''
+                SELECT parse_errors FROM syntax WHERE hash = ?
+            ''', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, source: Union[str, bytes], parse_errors: int) -> None:
+        key = content_hash(source)
+        with self._lock, self.conn:
+            self.conn.execute('''
+                INSERT OR REPLACE INTO syntax(hash, parse_errors)
+                VALUES (?, ?)
+            ''', (key, parse_errors))
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self, logger: logging.Logger) -> None:
+        logger.info("Syntax cache: %d hits, %d misses (%.1f%% hit rate)",
+                    self.hits, self.misses, 100 * self.hit_rate)
+
+
+def test_syntax_cache() -> None:
+    cache = SyntaxCache(':memory:')
+    assert cache.get(b'class A {') is None
+    cache.put(b'class A {', 1)
+    cache.put('class A { }', 0)
+    assert cache.get('class A {') == 1
+    assert cache.get(b'class A { }') == 0
+    assert (cache.hits, cache.misses) == (2, 1)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright 2017 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Keeps track of how much time is spent in each stage of a pipeline.
+"""
+
+import logging
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from typing import DefaultDict, Iterator
+
+
+class Timings:
+    """
+    Accumulates wall-clock time and number of calls per stage. Safe to share
+    between threads.
+    """
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self.seconds = defaultdict(float)  # type: DefaultDict[str, float]
+        self.calls = Counter()  # type: Counter
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += 1
+
+    def report(self, logger: logging.Logger) -> None:
+        """
+        Log a summary of each stage.
+        """
+        elapsed = time.perf_counter() - self.started
+        logger.info("Elapsed: %.1fs", elapsed)
+        with self._lock:
+            for stage in sorted(self.calls):
+                seconds, calls = self.seconds[stage], self.calls[stage]
+                logger.info("%s: %d calls, %.1fs total, %.2fms per call",
+                            stage, calls, seconds, 1000 * seconds / calls)
+
+
+def test_timings() -> None:
+    timings = Timings()
+    with timings.time('fetch'):
+        pass
+    timings.add('fetch', 1.0)
+    assert timings.calls['fetch'] == 2
+    assert timings.seconds['fetch'] >= 1.0
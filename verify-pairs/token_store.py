@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright 2017 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stores the token sequence of each source file, so that every file is lexed
+(by the Java server!) exactly once, no matter how many stages look at it.
+
+Each revision's tokens are stored as three packed arrays: the vocabulary
+index of every token, and the line and column where each token starts.
+"""
+
+import sqlite3
+import sys
+from array import array
+from typing import (
+    Any, Callable, Iterable, List, Optional, Sequence, Tuple, Union,
+)
+
+from database import WriteQueue
+from java import java, vind_encoder, JavaError
+from lexical_analysis import Token, TokenStream
+from mistakes import BatchWriter, MEID, Revision, SFID
+from vocabulary import vocabulary, Vind
+
+# Supplementary Private Use Area B
+PUA_B_START = 0x100000
+
+SCHEMA = r"""
+CREATE TABLE IF NOT EXISTS tokens(
+    source_file_id  INT,
+    meid            INT,
+    vinds           BLOB NOT NULL,  -- uint8 per token
+    lines           BLOB NOT NULL,  -- uint32 per token, little-endian
+    columns         BLOB NOT NULL,  -- uint32 per token, little-endian
+    PRIMARY KEY (source_file_id, meid)
+) WITHOUT ROWID;
+"""
+
+Source = Union[str, bytes]
+
+# Every vocabulary index must fit in one byte.
+assert len(vocabulary) <= 256
+
+
+def _positions(values: Iterable[int]) -> array:
+    positions = array('I', values)
+    assert positions.itemsize == 4
+    return positions
+
+
+def _to_blob(positions: array) -> bytes:
+    if sys.byteorder != 'little':
+        positions = array('I', positions)
+        positions.byteswap()
+    return positions.tobytes()
+
+
+def _from_blob(blob: bytes) -> array:
+    positions = _positions(())
+    positions.frombytes(blob)
+    if sys.byteorder != 'little':
+        positions.byteswap()
+    return positions
+
+
+class TokenSequence:
+    """
+    The tokens of one source file, as vocabulary indices with the line and
+    column where each token starts.
+    """
+    __slots__ = 'vinds', 'lines', 'columns', '_pua'
+
+    def __init__(self, vinds: bytes, lines: array, columns: array) -> None:
+        assert len(vinds) == len(lines) == len(columns)
+        self.vinds = vinds
+        self.lines = lines
+        self.columns = columns
+        self._pua = None  # type: Optional[str]
+
+    @classmethod
+    def from_tokens(cls, tokens: Iterable[Token]) -> 'TokenSequence':
+        if isinstance(tokens, TokenStream):
+            # Already columns: no need for a single Token.
+            return cls(tokens.vinds.tobytes(), tokens.start_lines,
+                       tokens.start_columns)
+        tokens = list(tokens)
+        return cls(bytes(vind_encoder.encode(token.name, token.value)
+                         for token in tokens),
+                   _positions(token.line for token in tokens),
+                   _positions(token.column for token in tokens))
+
+    @classmethod
+    def lex(cls, source: Union[str, bytes]) -> 'TokenSequence':
+        return cls.from_tokens(java.tokenize(source))
+
+    def __len__(self) -> int:
+        return len(self.vinds)
+
+    def __getitem__(self, index: int) -> Vind:
+        return Vind(self.vinds[index])
+
+    def to_pua(self) -> str:
+        """
+        Encodes the sequence as a string of one Private Use Area codepoint
+        per token, which can be operated on by the Levenshtein module.
+        """
+        if self._pua is None:
+            self._pua = ''.join(chr(PUA_B_START + vind)
+                                for vind in self.vinds)
+        return self._pua
+
+    def line_of(self, index: int) -> int:
+        """
+        Line number of the token at index; or of the last token, if the
+        index is past the end (e.g., an insertion at the end of file).
+        """
+        if not self.lines:
+            return 1
+        return self.lines[min(index, len(self.lines) - 1)]
+
+
+class TokenStore:
+    """
+    Token sequences of revisions, stored in the tokens table. New sequences
+    are written in batches; use as a context manager to write the last one.
+
+    A read-only store never writes; instead, it keeps new sequences in
+    unsaved, for some other process to put().
+    """
+    def __init__(self, conn: sqlite3.Connection, *,
+                 batch_size: int=1000, read_only: bool=False,
+                 writer: Optional[WriteQueue]=None) -> None:
+        self.conn = conn
+        self.writer = None  # type: Optional[BatchWriter]
+        if not read_only:
+            self.conn.executescript(SCHEMA)
+            self.writer = BatchWriter(conn, '''
+                INSERT OR IGNORE INTO tokens(
+                    source_file_id, meid, vinds, lines, columns
+                ) VALUES (?, ?, ?, ?, ?)
+            ''', batch_size=batch_size, writer=writer)
+        self.unsaved = []  # type: List[Tuple[Revision, TokenSequence]]
+        self.loaded = 0
+        self.lexed = 0
+
+    def get(self, revision: Revision) -> Optional[TokenSequence]:
+        row = self.conn.execute('''
+            SELECT vinds, lines, columns FROM tokens
+             WHERE source_file_id = ? AND meid = ?
+        ''', revision).fetchone()
+        if row is None:
+            return None
+        vinds, lines, columns = row
+        return TokenSequence(bytes(vinds), _from_blob(lines),
+                             _from_blob(columns))
+
+    def put(self, revision: Revision, tokens: TokenSequence) -> None:
+        if self.writer is None:
+            self.unsaved.append((revision, tokens))
+            return
+        sfid, meid = revision
+        self.writer.add((sfid, meid, tokens.vinds,
+                         _to_blob(tokens.lines), _to_blob(tokens.columns)))
+
+    def tokens_of(self, revision: Revision,
+                  source: Union[Source, Callable[[], Source]]
+                  ) -> TokenSequence:
+        """
+        Returns the stored tokens of the revision, lexing the source (and
+        storing the result) if they were never stored. The source may be a
+        function, to only load it if it needs lexing.
+        """
+        tokens = self.get(revision)
+        if tokens is not None:
+            self.loaded += 1
+            return tokens
+        if callable(source):
+            source = source()
+        tokens = TokenSequence.lex(source)
+        self.lexed += 1
+        self.put(revision, tokens)
+        return tokens
+
+    def tokens_of_many(self, items: Sequence[Tuple[Revision, Union[
+                           Source, Callable[[], Source]]]]
+                       ) -> List[Union[TokenSequence, JavaError]]:
+        """
+        tokens_of() every (revision, source) pair, lexing all the sources
+        that need it in one batch. Each source that can't be lexed gets a
+        JavaError instead.
+        """
+        results = [self.get(revision)
+                   for revision, _source in items]  # type: List[Any]
+        missing = [i for i, tokens in enumerate(results) if tokens is None]
+        self.loaded += len(items) - len(missing)
+        # Load every source on its own, so one that can't be loaded (e.g.,
+        # compressed, without zstandard) fails only its own revision.
+        loaded = []  # type: List[int]
+        sources = []  # type: List[Source]
+        for i in missing:
+            source = items[i][1]
+            try:
+                sources.append(source() if callable(source) else source)
+            except Exception as error:
+                results[i] = JavaError(f'Could not load source: '
+                                       f'{type(error).__name__}: {error}')
+            else:
+                loaded.append(i)
+        streams = java.tokenize_many(sources)
+        for i, stream in zip(loaded, streams):
+            if isinstance(stream, JavaError):
+                results[i] = stream
+                continue
+            tokens = TokenSequence.from_tokens(stream)
+            self.lexed += 1
+            self.put(items[i][0], tokens)
+            results[i] = tokens
+        return results
+
+    def flush(self) -> None:
+        if self.writer is not None:
+            self.writer.flush()
+
+    def __enter__(self) -> 'TokenStore':
+        return self
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def test_token_store() -> None:
+    store = TokenStore(sqlite3.connect(':memory:'))
+    revision = SFID(1), MEID(2)
+    source = b'class Hello {\n  int x;\n}'
+    tokens = store.tokens_of(revision, source)
+    assert tokens.to_pua()[0] == chr(PUA_B_START + vocabulary.to_index('class'))
+    assert list(tokens.lines) == [1, 1, 1, 2, 2, 2, 3]
+    store.flush()
+
+    def load_source() -> bytes:
+        raise AssertionError('stored tokens should not need the source')
+    stored = store.tokens_of(revision, load_source)
+    assert (store.lexed, store.loaded) == (1, 1)
+    assert stored.vinds == tokens.vinds
+    assert stored.lines == tokens.lines
+    assert stored.columns == tokens.columns
+    assert stored.line_of(len(stored)) == 3
+
+    many = store.tokens_of_many([
+        (revision, load_source),
+        ((SFID(1), MEID(3)), b'class Hello {'),
+        ((SFID(1), MEID(4)), b'class \xff'),
+        ((SFID(1), MEID(5)), load_source),
+    ])
+    first, second, undecodable, unloadable = many
+    assert not isinstance(first, JavaError) and first.vinds == stored.vinds
+    assert not isinstance(second, JavaError) and len(second) == 3
+    # Can't be decoded, or loaded; but that fails only those files.
+    assert isinstance(undecodable, JavaError)
+    assert isinstance(unloadable, JavaError)
+    assert (store.lexed, store.loaded) == (2, 2)
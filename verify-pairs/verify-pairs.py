@@ -17,18 +17,36 @@
 # License along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 
+import argparse
+import hashlib
 import logging
-import sqlite3
+import math
+import signal
 import sys
-from typing import Iterable, Tuple, NewType
-
-import requests
-
-from java import java
-
-SFID = NewType('SFID', int)
-MEID = NewType('MEID', int)
-Revision = Tuple[SFID, MEID]
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# Use tqdm only if it's installed.
+try:
+    from tqdm import tqdm  # type: ignore
+except ImportError:
+    def tqdm(it, *_args, **_kwargs):
+        yield from it
+
+from compression import Codec
+from database import connect
+from java import java, JavaError, JavaPool
+from mistakes import BatchWriter, MEID, Revision, SFID
+from rangeset import RangeSet
+from schedule import by_date, restore_order
+from section_9 import DateCache, DEFAULT_DATE_CACHE
+from pipeline import Pipeline, Stage
+from sources import DEFAULT_URL, DiskSource, HTTPSource, SourceNotFound
+from syntax_cache import SyntaxCache
+from timing import Timings
 
 
 SCHEMA = """
@@ -69,25 +87,140 @@ class Pair:
         )
 
 
+class Job:
+    """
+    A pair making its way through the pipeline. Stages fill in the sources,
+    or set `rejected` to the reason the pair is not a mistake; the last
+    check sets `checked`.
+    """
+    __slots__ = 'number', 'pair', 'before', 'after', 'rejected', 'checked'
+
+    def __init__(self, number: int, pair: Pair) -> None:
+        self.number = number
+        self.pair = pair
+        self.before = None  # type: Optional[bytes]
+        self.after = None  # type: Optional[bytes]
+        self.rejected = None  # type: Optional[str]
+        self.checked = False
+
+    @property
+    def is_mistake(self) -> bool:
+        """
+        True only if both sources were fetched and checked, and the pair
+        wasn't rejected.
+        """
+        return (self.rejected is None and self.checked
+                and self.before is not None and self.after is not None)
+
+    def failed(self, stage: str) -> None:
+        """
+        Marks the job as rejected because a stage failed on it.
+        """
+        if self.rejected is None:
+            self.rejected = f'error in {stage}'
+
+    def __repr__(self) -> str:
+        return "<job {:d} {!r}>".format(self.number, self.pair)
+
+
+class BloomFilter:
+    """
+    A set that might have false positives, but takes only a few bits per
+    item.
+    """
+    def __init__(self, capacity: int, error_rate: float=0.001) -> None:
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: int) -> Iterable[int]:
+        digest = hashlib.blake2b(str(key).encode('ASCII'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little')
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: int) -> None:
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: int) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+
+def pack(revision: Revision) -> int:
+    """
+    Packs a (sfid, meid) into a single int, which takes much less memory
+    than a tuple.
+    """
+    sfid, meid = revision
+    return sfid << 64 | meid
+
+
 class Mistakes:
     """
     Stores mistakes in a database.
+
+    The keys of all existing mistakes are loaded into memory at startup (or
+    into a Bloom filter, for huge databases), and new mistakes are inserted
+    in batches. Call close() (or use as a context manager) to write the last
+    batch. Safe to share between threads.
     """
-    def __init__(self) -> None:
-        self.conn = sqlite3.connect("java-mistakes.sqlite3")
+    def __init__(self, timings: Optional[Timings]=None, *,
+                 batch_size: int=1000, interval: float=5.0,
+                 bloom: bool=False, delta: bool=False) -> None:
+        self.conn = connect(check_same_thread=False)
         self.conn.executescript(SCHEMA)
+        # Compresses sources once compression.py has trained a dictionary.
+        self.codec = Codec(self.conn)
+        # Store after as a delta against before?
+        self.delta = delta
+        self._lock = threading.RLock()
         self.logger = logging.getLogger(type(self).__name__)
+        self.timings = timings or Timings()
+        # Duplicate pairs may be in flight at the same time; keep the first.
+        self.writer = BatchWriter(self.conn, """
+            INSERT OR IGNORE INTO mistake
+            (source_file_id, before_id, after_id, before, after)
+            VALUES (?, ?, ?, ?, ?)
+        """, batch_size=batch_size, interval=interval, lock=self._lock)
+        with self.timings.time('load keys'):
+            self.existing = self._load_existing(bloom)
+
+    def _load_existing(self, bloom: bool):
+        keys = self.conn.execute('''
+            SELECT source_file_id, before_id FROM mistake
+        ''')
+        if not bloom:
+            return {pack(key) for key in keys}
+
+        count, = self.conn.execute('SELECT COUNT(*) FROM mistake').fetchone()
+        # Leave room for the mistakes we're about to add.
+        existing = BloomFilter(2 * count + 1000000)
+        for key in keys:
+            existing.add(pack(key))
+        return existing
 
     def pair_exists(self, pair: Pair) -> bool:
         """
         Return True if the pair was already found in the database.
         """
-        cursor = self.conn.execute('''
-            SELECT COUNT(*)
-              FROM mistake
-             WHERE source_file_id = ? AND before_id = ?
-        ''', pair.before)
-        answer, = cursor.fetchone()
+        if pack(pair.before) not in self.existing:
+            return False
+        elif isinstance(self.existing, set):
+            return True
+
+        # The Bloom filter may have lied; ask the database.
+        with self._lock:
+            self.writer.flush()
+            cursor = self.conn.execute('''
+                SELECT COUNT(*)
+                  FROM mistake
+                 WHERE source_file_id = ? AND before_id = ?
+            ''', pair.before)
+            answer, = cursor.fetchone()
         return answer > 0
 
     def try_pair(self, pair: Pair) -> None:
@@ -98,67 +231,198 @@ class Mistakes:
             self.logger.info("Pair exists: %r", pair)
             return
 
-        try:
-            source_before = fetch_source(pair.before)
-            source_after = fetch_source(pair.after)
-        except requests.exceptions.HTTPError:
-            self.logger.warn("Not found: %r", pair)
-            return
+        job = Job(0, pair)
+        fetch(job)
+        check([job])
+        self.accept(job)
 
-        self.logger.info("Checking %r", pair)
-        if good_pair(source_before, source_after):
-            self.logger.info("Inserting: %r", pair)
-            self.insert(pair, source_before, source_after)
+    def accept(self, job: 'Job') -> None:
+        """
+        Inserts the pair if it was verified as good.
+        """
+        if job.rejected is None and not job.is_mistake:
+            # Something went wrong without the job being rejected; never
+            # insert a pair that wasn't verified.
+            self.logger.warning("Not verified: %r", job.pair)
+            job.rejected = 'not verified'
+        if job.is_mistake:
+            assert job.before is not None and job.after is not None
+            self.logger.info("Inserting: %r", job.pair)
+            with self.timings.time('insert'):
+                self.insert(job.pair, job.before, job.after)
 
     def insert(self, pair: Pair, before: bytes, after: bytes) -> None:
         """
         Insert the before/after source code into the database.
         """
-        with self.conn:
-            self.conn.execute("""
-                INSERT INTO mistake
-                (source_file_id, before_id, after_id, before, after)
-                VALUES (?, ?, ?, ?, ?)
-            """, (pair.source_file_id, pair.before_id, pair.after_id,
-                  before, after))
+        with self._lock:
+            self.existing.add(pack(pair.before))
+            if self.delta:
+                stored_after = self.codec.encode_delta(after, before)
+            else:
+                stored_after = self.codec.encode(after)
+            self.writer.add((pair.source_file_id, pair.before_id,
+                             pair.after_id, self.codec.encode(before),
+                             stored_after))
+
+    def close(self) -> None:
+        """
+        Writes any mistakes that have not yet been inserted.
+        """
+        self.writer.close()
+
+    def __enter__(self) -> 'Mistakes':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+# Replaced in main() according to the command line arguments.
+fetch_source = HTTPSource()
+
+
+def fetch_before(job: Job) -> None:
+    """
+    Pipeline stage: fetch the before source.
+    """
+    try:
+        job.before = fetch_source(job.pair.before)
+    except SourceNotFound:
+        logging.getLogger('fetch').warning("Not found: %r", job.pair)
+        job.rejected = 'before not found'
+
+
+def fetch_after(job: Job) -> None:
+    """
+    Pipeline stage: fetch the after source, unless the job was rejected.
+    """
+    if job.rejected is not None:
+        return
+    try:
+        job.after = fetch_source(job.pair.after)
+    except SourceNotFound:
+        logging.getLogger('fetch').warning("Not found: %r", job.pair)
+        job.rejected = 'after not found'
 
 
-def fetch_source(revision: Revision) -> bytes:
+def check_before(jobs: List[Job]) -> None:
     """
-    Get a source code file at a particular revision.
+    Pipeline stage: reject each job whose before has valid syntax.
     """
-    sfid, meid = revision  # type: Tuple[SFID, MEID]
-    r = requests.get('http://localhost:8080/',
-                     params=dict(sfid=sfid, meid=meid))
-    r.raise_for_status()
-    return r.content
+    checked, sources = [], []  # type: List[Job], List[bytes]
+    for job in jobs:
+        if job.rejected is not None:
+            continue
+        logging.getLogger('check').info("Checking %r", job.pair)
+        if job.before is None:
+            job.rejected = 'before missing'
+        else:
+            checked.append(job)
+            sources.append(job.before)
+    for job, rejected in zip(checked, before_rejections(sources)):
+        job.rejected = rejected
+
+
+def check_after(jobs: List[Job]) -> None:
+    """
+    Pipeline stage: reject each job whose after has invalid syntax.
+    """
+    checked, sources = [], []  # type: List[Job], List[bytes]
+    for job in jobs:
+        if job.rejected is not None:
+            continue
+        if job.after is None:
+            job.rejected = 'after missing'
+        else:
+            checked.append(job)
+            sources.append(job.after)
+    for job, rejected in zip(checked, after_rejections(sources)):
+        job.rejected = rejected
+        job.checked = True
+
+
+def fetch(job: Job) -> None:
+    """
+    Pipeline stage: fetch both sources.
+    """
+    fetch_before(job)
+    fetch_after(job)
+
+
+def check(jobs: List[Job]) -> None:
+    """
+    Pipeline stage: check the syntax of both sources.
+    """
+    check_before(jobs)
+    check_after(jobs)
 
 
 def good_pair(before: bytes, after: bytes) -> bool:
     """
     Return True if a pair of source files makes for a valid example.
     """
-    try:
-        return _good_pair(before, after)
-    except Exception:
-        # Javalang has bugs and will throw on some valid inputs, so just
-        # reject the pair if this is the case.
-        logger = logging.getLogger('good_pair')
-        logger.exception('Exception handling files')
-        return False
+    return rejection(before, after) is None
 
 
-def _good_pair(before: bytes, after: bytes) -> bool:
-    logger = logging.getLogger('good_pair')
-    if java.check_syntax(before) is True:
-        logger.info("Rejecting: before has valid syntax")
-        return False
+def rejection(before: bytes, after: bytes) -> Optional[str]:
+    """
+    Returns why the pair does not make for a valid example, or None if it
+    does.
+    """
+    return before_rejection(before) or after_rejection(after)
 
-    if java.check_syntax(after) is False:
-        logger.info("Rejecting: after has invalid syntax")
-        return False
 
-    return True
+def before_rejection(before: bytes) -> Optional[str]:
+    return before_rejections([before])[0]
+
+
+def after_rejection(after: bytes) -> Optional[str]:
+    return after_rejections([after])[0]
+
+
+def before_rejections(befores: List[bytes]) -> List[Optional[str]]:
+    logger = logging.getLogger('good_pair')
+    try:
+        results = java.check_syntax_many(befores)
+    except Exception:
+        # Not any one file's fault (e.g., the Java server or the pool);
+        # still, none of them were checked.
+        logger.exception('Exception checking %d files', len(befores))
+        return ['before exception'] * len(befores)
+    rejections = []  # type: List[Optional[str]]
+    for valid in results:
+        if isinstance(valid, JavaError):
+            # Javalang has bugs and will throw on some valid inputs, so just
+            # reject the pair if this is the case.
+            logger.error('Exception handling files: %s', valid)
+            rejections.append('before exception')
+        elif valid is True:
+            logger.info("Rejecting: before has valid syntax")
+            rejections.append('before has valid syntax')
+        else:
+            rejections.append(None)
+    return rejections
+
+
+def after_rejections(afters: List[bytes]) -> List[Optional[str]]:
+    logger = logging.getLogger('good_pair')
+    try:
+        results = java.check_syntax_many(afters)
+    except Exception:
+        logger.exception('Exception checking %d files', len(afters))
+        return ['after exception'] * len(afters)
+    rejections = []  # type: List[Optional[str]]
+    for valid in results:
+        if isinstance(valid, JavaError):
+            logger.error('Exception handling files: %s', valid)
+            rejections.append('after exception')
+        elif valid is False:
+            logger.info("Rejecting: after has invalid syntax")
+            rejections.append('after has invalid syntax')
+        else:
+            rejections.append(None)
+    return rejections
 
 
 def count(it: Iterable) -> int:
@@ -249,10 +513,318 @@ def test_good_pair():
     assert good_pair(bad_source, good_source)
 
 
-def main():
-    mistakes = Mistakes()
-    for pair in pairs():
-        mistakes.try_pair(pair)
+def test_rejection():
+    bad_source = b"class Hello {"
+    good_source = b"class Hello { }"
+    assert rejection(bad_source, good_source) is None
+    assert rejection(good_source, good_source) == 'before has valid syntax'
+    assert rejection(bad_source, bad_source) == 'after has invalid syntax'
+
+
+def test_job_is_mistake():
+    job = Job(0, Pair(1, 2, 3))
+    job.before, job.after = b"class Hello {", b"class Hello { }"
+    # Fetched, but never checked (e.g., a stage failed).
+    assert not job.is_mistake
+    check([job])
+    assert job.is_mistake
+
+    job = Job(1, Pair(1, 2, 3))
+    job.failed('fetch')
+    assert job.rejected == 'error in fetch' and not job.is_mistake
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    for key in range(0, 2000, 2):
+        bloom.add(pack((1, key)))
+    # No false negatives...
+    assert all(pack((1, key)) in bloom for key in range(0, 2000, 2))
+    # ...and few false positives.
+    false_positives = sum(pack((1, key)) in bloom for key in range(1, 2000, 2))
+    assert false_positives < 50
+
+
+def test_java_pool():
+    bad_source = b"class Hello {"
+    good_source = b"class Hello { }"
+    sources = [(bad_source, good_source), (good_source, good_source),
+               (bad_source, bad_source), (bad_source, good_source)] * 3
+    with JavaPool(2, stagger=0.1) as pool:
+        results = list(pool.map_ordered(good_pair, enumerate(sources),
+                                        args=lambda item: item[1],
+                                        window=3))
+    assert [i for (i, _), _ in results] == list(range(len(sources)))
+    assert [ok for _, ok in results] == [good_pair(*s) for s in sources]
+
+
+def test_check_syntax_many():
+    sources = [b"class Hello {", b"class Hello { }", b"class \xff { }"]
+    results = java.check_syntax_many(sources)
+    assert results[:2] == [False, True]
+    # One bad file doesn't fail the rest of the batch.
+    assert isinstance(results[2], JavaError)
+    assert before_rejections(sources) == [None, 'before has valid syntax',
+                                          'before exception']
+    with JavaPool(2, stagger=0.1) as pool:
+        java.pool = pool
+        try:
+            assert java.check_syntax_many(sources)[:2] == [False, True]
+            assert isinstance(java.check_syntax_many(sources)[2], JavaError)
+        finally:
+            java.pool = None
+
+
+def test_check_batch_failures():
+    def jobs():
+        good = Job(0, Pair(1, 2, 3))
+        good.before, good.after = b"class Hello {", b"class Hello { }"
+        # Fetching raised something other than SourceNotFound.
+        unfetched = Job(1, Pair(1, 4, 5))
+        bad_after = Job(2, Pair(1, 6, 7))
+        bad_after.before, bad_after.after = b"class Hello {", b"class Hello {"
+        return [good, unfetched, bad_after]
+
+    batch = jobs()
+    check(batch)
+    assert [job.rejected for job in batch] == [None, 'before missing',
+                                               'after has invalid syntax']
+    assert [job.is_mistake for job in batch] == [True, False, False]
+
+    # The whole batch fails at once: none of it gets in.
+    class BrokenPool:
+        def apply(self, func, args):
+            raise BrokenPipeError('Java server died')
+    java.pool = BrokenPool()
+    try:
+        batch = jobs()
+        check(batch)
+    finally:
+        java.pool = None
+    assert [job.rejected for job in batch] == ['before exception',
+                                               'before missing',
+                                               'before exception']
+    assert not any(job.is_mistake for job in batch)
+
+
+def test_syntax_cache():
+    java.syntax_cache = SyntaxCache(':memory:')
+    try:
+        assert good_pair(b"class Hello {", b"class Hello { }")
+        assert good_pair(b"class Hello {", b"class Hello { }")
+        assert java.syntax_cache.hits == 2
+        assert java.syntax_cache.misses == 2
+    finally:
+        java.syntax_cache = None
+
+
+def only_in(manifest: Optional[RangeSet],
+            pairs: Iterable[Pair]) -> Iterable[Pair]:
+    """
+    Keep only the pairs whose before_id is in the manifest (if given).
+    """
+    if manifest is None:
+        yield from pairs
+        return
+    for pair in pairs:
+        if pair.before_id in manifest:
+            yield pair
+
+
+def test_only_in():
+    given = [Pair(SFID(1), MEID(m), MEID(m + 1)) for m in (3, 10, 11, 40)]
+    manifest = RangeSet([(1, 10), (40, 40)])
+    assert [p.before_id for p in only_in(manifest, given)] == [3, 10, 40]
+    assert list(only_in(None, given)) == given
+
+
+parser = argparse.ArgumentParser(description='Verify pairs read from stdin')
+parser.add_argument('--manifest', type=RangeSet.load, default=None,
+                    help='only verify pairs whose before_id is in this '
+                         'range manifest (see rangeset.py)')
+parser.add_argument('--server', default=DEFAULT_URL,
+                    help='URL of compile-server.py (default: %(default)s)')
+parser.add_argument('--source-dir', default=None,
+                    help='read sources directly from the index- and '
+                         'payload- files in this directory, instead of '
+                         'asking compile-server.py')
+parser.add_argument('--date-cache', default=DEFAULT_DATE_CACHE,
+                    help='dates of master events, for --source-dir and '
+                         '--schedule-window (default: %(default)s)')
+parser.add_argument('--schedule-window', type=int, default=None,
+                    help='reorder every N pairs so that pairs whose sources '
+                         'are stored on the same date are fetched together')
+parser.add_argument('--keep-order', action='store_true',
+                    help='insert mistakes in the order they were read, '
+                         'even though stages may finish them out of order')
+parser.add_argument('--lazy', action='store_true',
+                    help='fetch and check before first; only fetch after '
+                         'if before has a syntax error')
+parser.add_argument('--queue-size', type=int, default=64,
+                    help='maximum pairs waiting in front of each stage '
+                         '(default: %(default)s)')
+parser.add_argument('--max-in-flight', type=int, default=8,
+                    help='number of threads fetching sources, and so the '
+                         'maximum number of concurrent requests to the '
+                         'server (default: %(default)s)')
+parser.add_argument('--retries', type=int, default=3,
+                    help='times to retry a request that failed because of '
+                         'a transient error (default: %(default)s)')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='number of processes checking syntax, each with '
+                         'its own Java server (default: %(default)s)')
+parser.add_argument('--check-batch', type=int, default=16,
+                    help='most sources checked in one trip to the Java '
+                         'server or pool (default: %(default)s)')
+parser.add_argument('--stagger', type=float, default=1.0,
+                    help='seconds between starting each Java server '
+                         '(default: %(default)s)')
+parser.add_argument('--batch-size', type=int, default=1000,
+                    help='mistakes to insert per transaction '
+                         '(default: %(default)s)')
+parser.add_argument('--batch-interval', type=float, default=5.0,
+                    help='maximum seconds to hold on to mistakes before '
+                         'inserting them (default: %(default)s)')
+parser.add_argument('--syntax-cache', default='syntax-cache.sqlite3',
+                    help='remember which sources parse in this database '
+                         '(default: %(default)s)')
+parser.add_argument('--no-syntax-cache', dest='syntax_cache',
+                    action='store_const', const=None,
+                    help='always ask the Java server')
+parser.add_argument('--bloom', action='store_true',
+                    help='remember existing mistakes in a Bloom filter '
+                         'instead of a set, to save memory')
+parser.add_argument('--delta', action='store_true',
+                    help='store after as a delta against before, which '
+                         'is usually a few bytes')
+
+
+def new_pairs(mistakes: Mistakes, pairs: Iterable[Pair]) -> Iterable[Pair]:
+    """
+    Skip pairs that are already in the database.
+    """
+    for pair in pairs:
+        if mistakes.pair_exists(pair):
+            mistakes.logger.info("Pair exists: %r", pair)
+        else:
+            yield pair
+
+
+def progress(jobs: Iterable[Job], pipeline: Pipeline,
+             interval: float=1.0) -> Iterator[Job]:
+    """
+    Shows the throughput and queue depth of each stage as jobs finish.
+    """
+    logger = logging.getLogger('progress')
+    bar = tqdm(jobs, unit='pair')
+    # The fallback for tqdm can't show a postfix, so log it less often.
+    if not hasattr(bar, 'set_postfix_str'):
+        interval = 30 * interval
+    last_update = time.monotonic()
+    for job in bar:
+        yield job
+        now = time.monotonic()
+        if now - last_update >= interval:
+            last_update = now
+            if hasattr(bar, 'set_postfix_str'):
+                bar.set_postfix_str(pipeline.status())
+            else:
+                logger.info(pipeline.status())
+
+
+def main(args):
+    global fetch_source
+    if args.source_dir is None:
+        fetch_source = HTTPSource(args.server, pool_size=args.max_in_flight,
+                                  retries=args.retries)
+    else:
+        fetch_source = DiskSource(args.source_dir,
+                                  DateCache(args.date_cache))
+    if args.syntax_cache is not None:
+        java.syntax_cache = SyntaxCache(args.syntax_cache)
+    # Make sure that pending mistakes are written when we're killed.
+    signal.signal(signal.SIGTERM, lambda *_args: sys.exit(1))
+    timings = Timings()
+    mistakes = Mistakes(timings, batch_size=args.batch_size,
+                        interval=args.batch_interval, bloom=args.bloom,
+                        delta=args.delta)
+
+    numbered = enumerate(new_pairs(mistakes, only_in(args.manifest, pairs())))
+    if args.schedule_window:
+        date_cache = DateCache(args.date_cache)
+        numbered = by_date(numbered, lambda item: item[1].before_id,
+                           date_cache.lookup_many, args.schedule_window)
+    jobs = (Job(number, pair) for number, pair in numbered)
+
+    # Syntax is checked in-process, or by one thread per pool worker;
+    # either way, cached results never leave this process.
+    if args.lazy:
+        # Most pairs are rejected because before already parses; don't
+        # bother fetching after for those.
+        stages = [
+            Stage('fetch before', fetch_before, workers=args.max_in_flight),
+            Stage('check before', check_before, workers=args.jobs,
+                  batch_size=args.check_batch),
+            Stage('fetch after', fetch_after, workers=args.max_in_flight),
+            Stage('check after', check_after, workers=args.jobs,
+                  batch_size=args.check_batch),
+        ]
+    else:
+        stages = [
+            Stage('fetch', fetch, workers=args.max_in_flight),
+            Stage('check', check, workers=args.jobs,
+                  batch_size=args.check_batch),
+        ]
+    pipeline = Pipeline(stages, maxsize=args.queue_size, timings=timings,
+                        on_error=Job.failed)
+    outcomes = Counter()  # type: Counter
+
+    try:
+        with ExitStack() as stack:
+            if args.jobs > 1:
+                java.pool = stack.enter_context(
+                    JavaPool(args.jobs, args.stagger)
+                )
+            finished = progress(pipeline.run(jobs), pipeline)
+            if args.keep_order:
+                finished = restore_order(finished,
+                                         number_of=lambda job: job.number)
+            # This thread is the one and only writer.
+            for job in finished:
+                mistakes.accept(job)
+                outcomes[job.rejected or 'accepted'] += 1
+    finally:
+        mistakes.close()
+        timings.report(mistakes.logger)
+        report_outcomes(outcomes, args.lazy, mistakes.logger)
+        if java.syntax_cache is not None:
+            java.syntax_cache.report(mistakes.logger)
+
+
+# Reasons a pair is rejected before its after is fetched, with --lazy.
+BEFORE_REJECTIONS = (
+    'before not found',
+    'before missing',
+    'before has valid syntax',
+    'before exception',
+    'error in fetch before',
+    'error in check before',
+)
+
+
+def report_outcomes(outcomes: Counter, lazy: bool,
+                    logger: logging.Logger) -> None:
+    """
+    Log why pairs were rejected, and how much work rejecting them early
+    saves (or would save, with --lazy).
+    """
+    for outcome, n in outcomes.most_common():
+        logger.info("%s: %d", outcome, n)
+    early = sum(outcomes[reason] for reason in BEFORE_REJECTIONS)
+    if lazy:
+        logger.info("Skipped fetching and checking after for %d pairs", early)
+    else:
+        logger.info("--lazy would skip fetching after for %d pairs", early)
 
 
 if __name__ == '__main__':
@@ -260,4 +832,4 @@ if __name__ == '__main__':
         test()
     else:
         logging.basicConfig(level=logging.INFO)
-        main()
+        main(parser.parse_args())
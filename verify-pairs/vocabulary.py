@@ -16,6 +16,7 @@
 # limitations under the License.
 
 import warnings
+from collections import Counter
 from typing import Any, Dict, Iterable, List, NewType, Sequence, Sized, Tuple
 from typing import cast
 
@@ -48,6 +49,8 @@ class Vocabulary(Sized):
         assert len(self._index2text) == len(set(self._index2text)), (
             'Duplicate entries in vocabulary'
         )
+        # How many times each unexpected entry was converted to <unk>.
+        self.unknown = Counter()  # type: Counter
 
     def entries(self) -> Iterable[Entry]:
         """
@@ -66,12 +69,26 @@ class Vocabulary(Sized):
         except KeyError:
             # Unks **SHOULD** only apply to error tokens...
             if text != '<ERROR>':
-                warnings.warn(f'Token converted to <unk>: {text!r}')
+                self.unknown[text] += 1
             return self.unk_token_index
 
+    def warn_unknown(self) -> None:
+        """
+        Warns once about every token converted to <unk> so far (other than
+        <ERROR>), and starts counting again.
+        """
+        if self.unknown:
+            counts = ', '.join(f'{text!r} ({n})'
+                               for text, n in self.unknown.most_common())
+            warnings.warn(f'Tokens converted to <unk>: {counts}')
+            self.unknown.clear()
+
     def __len__(self) -> int:
         return len(self._index2text)
 
+    def __contains__(self, text: object) -> bool:
+        return text in self._text2index
+
     def __getitem__(self, idx: Vind) -> Entry:
         return self._index2text[idx]
 